@@ -0,0 +1,116 @@
+'''
+Micro-benchmark of line tuple generation.
+
+Times nonogram_csp.line_tuples against the original recursive generator
+on every row and column of the problems in problems.py, e.g.
+
+    python bench_tuples.py                  # all problems
+    python bench_tuples.py --problem 24     # a single problem
+    python bench_tuples.py --verify         # also compare the outputs
+'''
+
+import time
+import argparse
+from nonogram_csp import line_tuples
+from problems import *
+
+NUM_TESTS = 42
+
+
+def recursive_tuples(_span, _constraint, valid_tuples, current_tuple=[]):
+    '''The original recursive generator, kept as the reference to
+       benchmark against'''
+    # If empty row, convert to empty list consistent with algo
+    if(_constraint == [0]):
+        _constraint = []
+
+    span = _span
+    constraint = list(_constraint)
+
+    if(span == 0):
+        if(len(constraint) == 0):
+            valid_tuples.append(current_tuple)
+        return
+
+    # Either pop a constraint, or assign a 0
+    # Assign 0
+    temp = list(current_tuple)
+    temp.append(0)
+    recursive_tuples(span-1, constraint, valid_tuples, temp)
+
+    # Pop constraint
+    if(len(constraint) != 0):
+        temp = list(current_tuple)
+        top_constraint = constraint.pop(0)
+        if (top_constraint > span):
+            # con't fit constraint
+            return
+        for i in range(top_constraint):
+            # "Color in" the specified number
+            temp.append(1)
+        span -= top_constraint
+
+        if(span > 0):
+            # If there is space left, there must be a gap
+            temp.append(0)
+            span -= 1
+
+        recursive_tuples(span, constraint, valid_tuples, temp)
+
+
+def bench_problem(test_id, verify):
+    '''Return (number of tuples, recursive time, line_tuples time) summed
+       over every line of the problem'''
+    row, col = getProblem(test_id)
+    lines = [(len(col), clue) for clue in row] + [(len(row), clue) for clue in col]
+
+    n_tuples = 0
+    old_time = 0
+    new_time = 0
+    for span, clue in lines:
+        start = time.perf_counter()
+        old = []
+        recursive_tuples(span, clue, old)
+        old_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        n_new = 0
+        for t in line_tuples(span, clue):
+            n_new += 1
+        new_time += time.perf_counter() - start
+
+        if n_new != len(old) or (verify and
+                                 set(map(tuple, old)) != set(line_tuples(span, clue))):
+            print("Mismatch on line", span, clue)
+        n_tuples += len(old)
+    return n_tuples, old_time, new_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark line tuple generation.')
+    parser.add_argument('--problem', type=int, help='problem number to benchmark')
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='check both generators produce the same tuples')
+    parser.set_defaults(verify=False)
+    args = parser.parse_args()
+
+    if args.problem is not None:
+        test_ids = [args.problem]
+    else:
+        test_ids = range(NUM_TESTS)
+
+    total_old = 0
+    total_new = 0
+    print("{:>7} {:>10} {:>12} {:>12} {:>8}".format(
+        "problem", "tuples", "recursive", "line_tuples", "speedup"))
+    for test_id in test_ids:
+        n_tuples, old_time, new_time = bench_problem(test_id, args.verify)
+        total_old += old_time
+        total_new += new_time
+        print("{:>7} {:>10} {:>11.3f}s {:>11.3f}s {:>7.1f}x".format(
+            test_id, n_tuples, old_time, new_time, old_time / max(new_time, 1e-9)))
+    print("\nTotal: recursive {:.3f}s, line_tuples {:.3f}s".format(total_old, total_new))
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,87 @@
+'''
+Brute-force check of the dom/wdeg variable ordering.
+
+Searches problems from problems.py with orderings.ord_wdeg, twice with
+the same BT so that the second search starts from BT.reset. Before
+every pick the dom/wdeg key of each unassigned variable is recomputed
+from scratch; the pick must have the smallest one, and every key the
+WdegIndex holds must match its variable's current key. e.g.
+
+    python check_wdeg.py                    # problems 1 to 10
+    python check_wdeg.py --problem 3        # a single problem
+'''
+
+import argparse
+import contextlib
+import io
+import nonogram_csp
+import orderings
+from cspbase import BT
+from propagators import prop_GAC
+from problems import *
+
+
+def brute_key(csp, var):
+    '''The dom/wdeg key of var computed from scratch (see wdeg_key)'''
+    wdeg = 0
+    for c in csp.get_cons_with_var(var):
+        if sum(1 for v in c.get_scope() if not v.is_assigned()) > 1:
+            wdeg += c.weight
+    if not wdeg:
+        return float('inf')
+    return var.cur_domain_size() / wdeg
+
+
+class CheckedWdeg:
+    '''ord_wdeg, checking every pick against brute_key'''
+
+    def __init__(self):
+        self.picks = 0
+        self.errors = 0
+
+    def __call__(self, csp):
+        var = orderings.ord_wdeg(csp)
+        self.picks += 1
+        index = csp.order_index
+        stale = [v for v in index.keys if index.keys[v] != orderings.wdeg_key(v, index)]
+        unasgn = csp.get_all_unasgn_vars()
+        main = [v for v in unasgn if v not in csp.aux_vars] or unasgn
+        best = min(brute_key(csp, v) for v in main)
+        if stale or brute_key(csp, var) != best:
+            self.errors += 1
+        return var
+
+
+def check_problem(test_id):
+    '''Return (picks, bad picks) over two searches of the problem'''
+    row, col = getProblem(test_id)
+    csp, var_array = nonogram_csp.nonogram_csp_model(row, col)
+    solver = BT(csp)
+    ordering = CheckedWdeg()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(2):
+            solver.bt_search(prop_GAC, ordering, orderings.val_arbitrary)
+    return ordering.picks, ordering.errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the dom/wdeg variable ordering.')
+    parser.add_argument('--problem', type=int, help='problem number to check')
+    args = parser.parse_args()
+
+    if args.problem is not None:
+        test_ids = [args.problem]
+    else:
+        test_ids = range(1, 11)
+
+    failed = 0
+    for test_id in test_ids:
+        picks, errors = check_problem(test_id)
+        print("{:>7} {:>8} picks {:>6} bad".format(test_id, picks, errors))
+        if errors:
+            failed += 1
+    print("\n{} of {} problems with bad picks".format(failed, len(test_ids)))
+
+
+if __name__=="__main__":
+    main()
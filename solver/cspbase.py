@@ -1,5 +1,12 @@
 import time
 import functools
+import itertools
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None   #MatrixTable is unavailable
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -11,14 +18,22 @@ import functools
       added but NOT deleted from.
       
       To support constraint propagation, the class also maintains a
-      set of flags to indicate if a value is still in its current domain.
+      bitmask to indicate if a value is still in its current domain.
       So one can remove values, add them back, and query if they are 
       still current. 
 
     B) class constraint
 
       This class allows one to define constraints specified by tables
-      of satisfying assignments.
+      of satisfying assignments. By default the table is also kept in
+      compact-table form (one bitmask of tuples per variable value) so
+      that support checks are bitwise operations.
+
+      The table itself is a TupleTable, indexed by scope position
+      rather than by variable, so constraints over the same relation
+      can share one table. If NumPy is installed a MatrixTable can be
+      used instead: it keeps the tuples as one 2D array and lets
+      revise_scope check the whole scope with vectorized operations.
 
       On initialization the variables the constraint is over is
       specified (i.e. the scope of the constraint). This must be an
@@ -30,7 +45,19 @@ import functools
       for each variable in the constraint (in the same ORDER as the
       variables of the constraint were specified).
 
-    C) Backtracking routine---takes propagator and CSP as arguments
+    C) class Trail
+
+      A single undo stack for the reversible search state (pruned
+      domain values and any constraint data registered with it).
+      Search takes a checkpoint per level and backtracking pops the
+      trail back to it.
+
+      class PropagationEngine
+
+      Worklist of constraints to revise, fed by the domain change
+      events variables send to the constraints on them.
+
+    D) Backtracking routine---takes propagator and CSP as arguments
        so that basic backtracking, forward-checking or GAC can be 
        executed depending on the propagator used.
 
@@ -45,8 +72,9 @@ class Variable:
 
        The variable object offers two types of functionality to support
        search. 
-       (a) It has a current domain, implimented as a set of flags 
-           determining which domain values are "current", i.e., unpruned.
+       (a) It has a current domain, implimented as an integer bitmask
+           (one bit per domain value) determining which domain values
+           are "current", i.e., unpruned.
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
              how many are still there
@@ -72,6 +100,11 @@ class Variable:
            flags are not changed so that pruning and unpruning can
            work independently of assignment and unassignment. 
            '''
+    #Bumped on every change to any variable's current domain or
+    #assignment. Constraints compare it against the value they last saw
+    #to skip re-reading their scope when nothing has changed.
+    stamp = 0
+
     #
     #set up and info methods
     #
@@ -80,17 +113,31 @@ class Variable:
         string). Optionally specify the initial domain.
         '''
         self.name = name                #text name for variable
+        #variable ordering index told about changes to the domain size
+        #and assignment of the variable (see orderings.VarIndex)
+        self.order_index = None
         self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        self.bits = dict()              #value --> its bit in curdom
+        self.full_mask = 0              #bitmask with every domain value set
+        self.curdom = 0                 #bitmask of CURRENT domain values
+        self.curdom_size = 0            #number of bits set in curdom
+        for val in self.dom:
+            self.add_bit(val)
+        self.restore_curdom()
         #for bt_search
         self.assignedValue = None
+        self.assign_mark = None         #trail checkpoint taken on assign
+        #(constraint, position in its scope) pairs told about domain changes
+        self.watchers = []
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
             self.dom.append(val)
-            self.curdom.append(True)
+            if self.add_bit(val):
+                self.curdom |= self.bits[val]
+                self.curdom_size += 1
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -106,46 +153,85 @@ class Variable:
 
     def prune_value(self, value):
         '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        bit = self.bits[value]
+        if self.curdom & bit:
+            self.curdom ^= bit
+            self.curdom_size -= 1
+            Variable.stamp += 1
+            if Trail.active is not None:
+                Trail.active.push_prune(self, value)
+            if self.order_index is not None:
+                self.order_index.changed(self)
+            self.notify(bit)
+
+    def prune_mask(self, mask):
+        '''Remove every value whose bit is set in mask from the CURRENT
+           domain at once: one trail entry and one domain change event
+           instead of one per value'''
+        removed = self.curdom & mask
+        if removed:
+            n = bin(removed).count('1')
+            self.curdom ^= removed
+            self.curdom_size -= n
+            Variable.stamp += 1
+            if Trail.active is not None:
+                Trail.active.push_prune_mask(self, removed, n)
+            if self.order_index is not None:
+                self.order_index.changed(self)
+            self.notify(removed)
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        bit = self.bits[value]
+        if not self.curdom & bit:
+            self.curdom |= bit
+            self.curdom_size += 1
+            Variable.stamp += 1
+            if self.order_index is not None:
+                self.order_index.changed(self)
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
-        vals = []
-        if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
-        return vals
+        if self.assignedValue is not None:
+            return [self.assignedValue]
+        if self.curdom == self.full_mask:
+            return list(self.dom)
+        curdom = self.curdom
+        bits = self.bits
+        return [val for val in self.dom if curdom & bits[val]]
 
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        bit = self.bits.get(value)
+        if bit is None:
             return False
-        if self.is_assigned():
-            return value == self.get_assigned_value()
-        else:
-            return self.curdom[self.value_index(value)]
+        if self.assignedValue is not None:
+            return value == self.assignedValue
+        return self.curdom & bit != 0
+
+    def cur_domain_mask(self):
+        '''Return the CURRENT domain as a bitmask over self.bits (if
+           assigned only the assigned value's bit is set)'''
+        if self.assignedValue is not None:
+            return self.bits[self.assignedValue]
+        return self.curdom
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
-        if self.is_assigned():
+        if self.assignedValue is not None:
             return 1
-        else:
-            return(sum(1 for v in self.curdom if v))
+        return self.curdom_size
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.curdom = self.full_mask
+        self.curdom_size = len(self.bits)
+        Variable.stamp += 1
+        if self.order_index is not None:
+            self.order_index.changed(self)
 
     #
     #methods for assigning and unassigning
@@ -164,14 +250,30 @@ class Variable:
                   "that is already assigned or illegal value (not in curdom)")
             return
 
+        if Trail.active is not None:
+            self.assign_mark = Trail.active.checkpoint()
         self.assignedValue = value
+        Variable.stamp += 1
+        if self.order_index is not None:
+            self.order_index.changed(self)
+        removed = self.curdom & ~self.bits[value]
+        if removed:
+            self.notify(removed)
 
     def unassign(self):
-        '''Used by bt_search. Unassign and restore old curdom'''
+        '''Used by bt_search. Unassign and restore old curdom. During
+           search this also undoes everything recorded on the trail
+           since the assignment was made'''
         if not self.is_assigned():
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
+        if Trail.active is not None and self.assign_mark is not None:
+            Trail.active.backtrack(self.assign_mark)
+        self.assign_mark = None
         self.assignedValue = None
+        Variable.stamp += 1
+        if self.order_index is not None:
+            self.order_index.changed(self)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
@@ -186,6 +288,39 @@ class Variable:
            in the domain list of a variable value'''
         return self.dom.index(value)
 
+    def trail_undo(self, value, mask):
+        '''Undo a pruning recorded on the trail: of value, or of the
+           values in mask if it is not None (see prune_mask)'''
+        if mask is None:
+            self.unprune_value(value)
+        else:
+            self.curdom |= mask
+            self.curdom_size += bin(mask).count('1')
+            Variable.stamp += 1
+            if self.order_index is not None:
+                self.order_index.changed(self)
+
+    def notify(self, removed):
+        '''Send the domain change event "the values in bitmask removed
+           have left the current domain" to the constraints watching
+           this variable, and schedule them on the active propagation
+           engine'''
+        engine = PropagationEngine.active
+        for c, i in self.watchers:
+            c.domain_changed(i, removed)
+            if engine is not None:
+                engine.schedule(c, self)
+
+    def add_bit(self, value):
+        '''Give a new domain value the next free bit of curdom. Returns
+           False if the value already has one'''
+        if value in self.bits:
+            return False
+        bit = 1 << len(self.bits)
+        self.bits[value] = bit
+        self.full_mask |= bit
+        return True
+
     def __repr__(self):
         return("Var-{}".format(self.name))
 
@@ -194,16 +329,17 @@ class Variable:
 
     def print_all(self):
         '''Also print the variable domain and current domain'''
+        curdom = [val for val in self.dom if self.curdom & self.bits[val]]
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             curdom))
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
        the satisfied function which tests if an assignment to the
        variables in the constraint's scope satisfies the constraint'''
 
-    def __init__(self, name, scope): 
+    def __init__(self, name, scope, compact=True): 
         '''create a constraint object, specify the constraint name (a
         string) and its scope (an ORDERED list of variable objects).
         The order of the variables in the scope is critical to the
@@ -217,32 +353,117 @@ class Constraint:
         NOTE: This is a very space expensive representation...a proper
         constraint object would allow for representing the constraint
         with a function.  
+
+        If compact is True support checks use the compact-table
+        representation: every satisfying tuple gets a bit, each
+        variable/value pair keeps the bitmask of the tuples it appears
+        in, and the tuples still valid under the current domains are
+        kept as one more bitmask (ct_live) that is shrunk as values are
+        pruned. A support test is then a single '&'.
         '''
 
         self.scope = list(scope)
         self.name = name
-        self.sat_tuples = dict()
 
-        #The next object data item 'sup_tuples' will be used to help
-        #support GAC propgation. It allows access to a list of 
-        #satisfying tuples that contain a particular variable/value
-        #pair.
-        self.sup_tuples = dict()
+        #The table of satisfying tuples (see TupleTable). The
+        #properties 'tuples' and 'sat_tuples' below are views of it:
+        #'tuples' lists the distinct satisfying tuples and 'sat_tuples'
+        #holds them for membership tests.
+        self.table = TupleTable()
+
+        #The property 'sup_tuples' will be used to help support GAC
+        #propgation. It allows access to a list of satisfying tuples
+        #that contain a particular variable/value pair. The lists
+        #belong to the table; the dict is built on first use (held in
+        #sup_views) so tables that are only used through their masks
+        #never have to list their tuples.
+        self.sup_views = None
+
+        #Residual supports: the last tuple has_support found for a
+        #variable/value pair. It is tried before scanning sup_tuples
+        #again, and needs no restoring on backtrack since it is
+        #re-validated on every use.
+        self.residues = dict()
+
+        #Compact-table data. Tuple k of the table is bit k of the masks
+        #below. The masks are (re)built lazily by ct_build once tuples
+        #have been added.
+        self.compact = compact
+        self.ct_dirty = False
+        self.ct_supports = []      #per scope position: {bit of value: tuple mask}
+        self.ct_var_supports = dict()  #(var,val) --> tuple mask
+        self.ct_live = 0           #tuples valid under ct_masks
+        self.ct_masks = []         #per scope position: domain mask ct_live reflects
+        self.ct_stamp = -1         #Variable.stamp when ct_live was last refreshed
+        self.ct_trail = None       #trail of the search whose events maintain ct_live
+
+        #Simple Tabular Reduction data, see str_revise. 'str_rows'
+        #holds the tuples with each value replaced by its domain bit;
+        #the first 'str_size' rows are the ones still valid under the
+        #domain masks 'str_masks'. Both are saved on the trail of the
+        #search they belong to ('str_trail').
+        self.str_rows = None
+        self.str_size = 0
+        self.str_masks = None
+        self.str_trail = None
+
+        #Conflict weight: the number of times (plus one) a propagator
+        #found the constraint wiping out a domain, see record_wipeout
+        self.weight = 1
 
     def add_satisfying_tuples(self, tuples):
         '''We specify the constraint by adding its complete list of satisfying tuples.'''
-        for x in tuples:
-            #print(x)
-            t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
-
-            #now put t in as a support for all of the variable values in it
-            for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var,val) in self.sup_tuples:
-                    self.sup_tuples[(var,val)] = []
-                self.sup_tuples[(var,val)].append(t)
+        if self.table.shared:
+            #never modify a table other constraints may be using
+            self.table = self.table.copy()
+        self.table.add_tuples(tuples)
+        self.set_table(self.table)
+
+    def set_table(self, table):
+        '''Make the constraint use table (a TupleTable whose tuples are
+           ordered like the scope) as its set of satisfying tuples. The
+           table is shared, not copied; the constraint only keeps
+           per-variable views of its per-position indexes.'''
+        if len(table) and table.arity != len(self.scope):
+            print("Trying to give constraint ", self, " a table of the wrong arity")
+            return
+        self.table = table
+        self.sup_views = None
+        self.residues = dict()
+        self.ct_dirty = True
+        self.ct_trail = None
+        self.str_rows = None
+        self.str_trail = None
+        self.notify_order_index()
+
+    @property
+    def tuples(self):
+        '''list of the distinct satisfying tuples'''
+        return self.table.tuples
+
+    @property
+    def sat_tuples(self):
+        '''dict with the satisfying tuples as keys'''
+        return self.table.sat_tuples
+
+    @property
+    def sup_tuples(self):
+        '''dict (var,val) --> list of the satisfying tuples containing
+           that variable/value pair'''
+        if self.sup_views is None:
+            views = dict()
+            table_sups = self.table.sup_tuples
+            for i, var in enumerate(self.scope):
+                if i >= len(table_sups):
+                    break
+                for val, sup in table_sups[i].items():
+                    if (var, val) in views:
+                        #var occurs more than once in the scope
+                        views[(var, val)] = views[(var, val)] + sup
+                    else:
+                        views[(var, val)] = sup
+            self.sup_views = views
+        return self.sup_views
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
@@ -255,7 +476,7 @@ class Constraint:
            constraints "satisfies" function.  Note the list of values
            are must be ordered in the same order as the list of
            variables in the constraints scope'''
-        return tuple(vals) in self.sat_tuples
+        return self.table.contains(vals)
 
     def get_n_unasgn(self):
         '''return the number of unassigned variables in the constraint's scope'''
@@ -279,12 +500,146 @@ class Constraint:
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
         '''
+        if self.compact and len(self.table):
+            self.ct_sync()
+            sup = self.ct_var_supports.get((var, val), 0)
+            return self.ct_live & sup != 0
+        res = self.residues.get((var, val))
+        if res is not None and self.tuple_is_valid(res):
+            return True
         if (var, val) in self.sup_tuples:
             for t in self.sup_tuples[(var, val)]:
                 if self.tuple_is_valid(t):
+                    self.residues[(var, val)] = t
                     return True
         return False
 
+    def support_count(self, var, val):
+        '''Return the number of satisfying tuples still valid under the
+           current domains that give var the value val: with the
+           compact table, the number of bits of ct_live set in the mask
+           of the pair. Constraints without a table count 1 if the pair
+           has a support and 0 if not.'''
+        if self.compact and len(self.table):
+            self.ct_sync()
+            return bin(self.ct_live & self.ct_var_supports.get((var, val), 0)).count('1')
+        if len(self.table):
+            return sum(1 for t in self.sup_tuples.get((var, val), []) if self.tuple_is_valid(t))
+        return 1 if self.has_support(var, val) else 0
+
+    def supports_given(self, var, val):
+        '''Return, for every position of the scope, the mask of the
+           values of its variable that would still have a supporting
+           tuple if var were assigned val, or None if the constraint
+           cannot tell (it has no table). With the compact table these
+           are the values whose tuple masks meet ct_live restricted to
+           the tuples of (var, val).'''
+        if self.compact and len(self.table):
+            self.ct_sync()
+            after = self.ct_live & self.ct_var_supports.get((var, val), 0)
+            masks = []
+            for i, u in enumerate(self.scope):
+                mask = 0
+                for bit, sup in self.ct_supports[i].items():
+                    if after & sup:
+                        mask |= bit
+                masks.append(mask)
+            return masks
+        if len(self.table):
+            masks = [0] * len(self.scope)
+            for t in self.sup_tuples.get((var, val), []):
+                if self.tuple_is_valid(t):
+                    for i, u in enumerate(self.scope):
+                        masks[i] |= u.bits.get(t[i], 0)
+            return masks
+        return None
+
+    def count_ruled_out(self, var, val):
+        '''Return the number of values of the other unassigned
+           variables of the scope that have a support now and would
+           have none if var were assigned val (see supports_given), as
+           used by val_lcv. 0 if the constraint cannot tell.'''
+        after = self.supports_given(var, val)
+        if after is None:
+            return 0
+        n = 0
+        for u, mask in zip(self.scope, after):
+            if u is var or u.is_assigned():
+                continue
+            for w in u.cur_domain():
+                if not mask & u.bits[w] and self.has_support(u, w):
+                    n += 1
+        return n
+
+    def record_wipeout(self):
+        '''Called by a propagator when the constraint leaves a variable
+           of its scope without values (or an assigned variable without
+           support), i.e. causes a failure. Bumps the constraint's
+           weight, which conflict-directed variable orderings use (see
+           orderings.ord_wdeg), and tells the ordering index of each
+           variable of the scope.'''
+        self.weight += 1
+        self.notify_order_index()
+
+    def notify_order_index(self):
+        '''Tell the ordering index of each variable of the scope (see
+           orderings.VarIndex) that the constraint has changed, e.g. its
+           weight or its table, so that keys read from it are updated'''
+        for var in self.scope:
+            if var.order_index is not None:
+                var.order_index.changed(var)
+
+    def solution_densities(self):
+        '''Return dict (var, val) --> solution density of the pair, for
+           the unassigned variables of the scope: the fraction of the
+           tuples still valid under the current domains that give var
+           the value val (see support_count). Nothing is cached here:
+           orderings.SDIndex keeps the densities and only asks the
+           constraints whose scope changed.'''
+        sd = dict()
+        total = None
+        for var in self.scope:
+            if var.is_assigned():
+                continue
+            counts = [(val, self.support_count(var, val)) for val in var.cur_domain()]
+            if total is None:
+                #every valid tuple gives the first variable one value
+                total = sum(n for val, n in counts)
+            for val, n in counts:
+                sd[(var, val)] = n / total if total else 0.0
+        return sd
+
+    def revise_scope(self):
+        '''Batched revision of the whole scope: return the (var, val)
+           pairs of the scope left without a supporting tuple, like
+           str_revise. The rows of the table's matrix that are valid
+           under the current domains are selected, and their values
+           OR-ed together column by column, all in NumPy.
+
+           Returns None if the table has no matrix (see MatrixTable);
+           has_support must then be used.'''
+        table = self.table
+        if table.matrix is None or not len(table):
+            return None
+        rows = table.get_bit_matrix([var.bits for var in self.scope])
+        if rows is None:
+            return None
+        masks = [var.cur_domain_mask() for var in self.scope]
+        valid = ((rows & np.array(masks, dtype=rows.dtype)) != 0).all(axis=1)
+        if valid.any():
+            sup = np.bitwise_or.reduce(rows[valid], axis=0).tolist()
+        else:
+            sup = [0] * len(masks)
+
+        unsupported = []
+        for var, mask, s in zip(self.scope, masks, sup):
+            lost = mask & ~s
+            if lost:
+                for val in var.dom:
+                    if var.bits[val] & lost:
+                        unsupported.append((var, val))
+        return unsupported
+
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
            corresponding variable domains'''
@@ -293,9 +648,420 @@ class Constraint:
                 return False
         return True
 
+    #
+    #compact-table routines
+    #
+
+    def ct_build(self):
+        '''Internal routine. Map the table's per position/value tuple
+           masks to the domain bits of the scope and reset ct_live.'''
+        table_masks = self.table.get_masks()
+        self.ct_supports = []
+        self.ct_var_supports = dict()
+        for i, var in enumerate(self.scope):
+            masks = dict()
+            for val, mask in table_masks[i].items():
+                if val in var.bits:
+                    masks[var.bits[val]] = mask
+                key = (var, val)
+                if key in self.ct_var_supports:
+                    #var occurs more than once in the scope
+                    self.ct_var_supports[key] |= mask
+                else:
+                    #the table's own mask, not a copy
+                    self.ct_var_supports[key] = mask
+            self.ct_supports.append(masks)
+
+        self.ct_dirty = False
+        self.ct_trail = None
+        self.ct_reset()
+
+    def ct_reset(self):
+        '''Internal routine. Recompute ct_live from scratch against the
+           current domains of the scope.'''
+        live = (1 << len(self.table)) - 1
+        self.ct_masks = []
+        for i, var in enumerate(self.scope):
+            mask = var.cur_domain_mask()
+            self.ct_masks.append(mask)
+            live &= self.ct_union(i, mask)
+        self.ct_live = live
+        self.ct_stamp = Variable.stamp
+
+    def ct_sync(self):
+        '''Internal routine. Make sure ct_live reflects the current
+           domains. During search domain_changed events maintain it; the
+           first time a search touches the constraint ct_live is
+           recomputed, after saving the old state on the trail so that
+           backtracking past this point hands the constraint back to
+           ct_refresh. Outside search ct_refresh is used.'''
+        if self.ct_dirty:
+            self.ct_build()
+        trail = Trail.active
+        if trail is None:
+            self.ct_refresh()
+        elif self.ct_trail is not trail:
+            trail.save(self, 'ct_trail', self.ct_trail)
+            trail.save(self, 'ct_live', self.ct_live)
+            trail.save(self, 'ct_masks', self.ct_masks)
+            trail.save(self, 'ct_stamp', self.ct_stamp)
+            self.ct_reset()
+            self.ct_trail = trail
+
+    def ct_refresh(self):
+        '''Internal routine. Bring ct_live up to date with the current
+           domains. Values removed since the last refresh just mask out
+           their tuples; if any value came back (we backtracked) ct_live
+           is recomputed.'''
+        if self.ct_dirty:
+            self.ct_build()
+            return
+        if self.ct_stamp == Variable.stamp:
+            return
+        live = self.ct_live
+        masks = self.ct_masks
+        for i, var in enumerate(self.scope):
+            mask = var.cur_domain_mask()
+            old = masks[i]
+            if mask == old:
+                continue
+            if mask & ~old:
+                self.ct_reset()
+                return
+            removed = old & ~mask
+            if bin(removed).count('1') < bin(mask).count('1'):
+                live &= ~self.ct_union(i, removed)
+            else:
+                live &= self.ct_union(i, mask)
+            masks[i] = mask
+        self.ct_live = live
+        self.ct_stamp = Variable.stamp
+
+    def trail_undo(self, attr, old):
+        '''Undo a change to one of the constraint's reversible attributes
+           recorded on the trail by Trail.save'''
+        setattr(self, attr, old)
+
+    def domain_changed(self, i, removed):
+        '''Domain change event: the values whose bits are set in removed
+           have left the current domain of the variable at scope
+           position i. During search this is what keeps ct_live up to
+           date: the tuples using those values are masked out and the
+           old ct_live is saved on the trail.'''
+        trail = self.ct_trail
+        if trail is None or trail is not Trail.active:
+            return
+        live = self.ct_live & ~self.ct_union(i, removed)
+        if live != self.ct_live:
+            trail.save(self, 'ct_live', self.ct_live)
+            self.ct_live = live
+
+    #
+    #simple tabular reduction routines
+    #
+
+    def str_revise(self):
+        '''Simple Tabular Reduction (STR2). Drop the tuples that are no
+           longer valid from the live part of the table (by swapping them
+           past its end) and return the list of (var, val) pairs of the
+           scope that are left without a supporting tuple. An assigned
+           variable's value is returned too if it has lost its support.
+
+           The live size and the masks it was computed under are saved
+           on the active trail, so backtracking restores them. With no
+           active trail the whole table is filtered on every call.'''
+        trail = Trail.active
+        if self.str_rows is None:
+            self.str_rows = list(self.table.get_bit_rows([var.bits for var in self.scope]))
+            self.str_trail = None
+        if trail is None or self.str_trail is not trail:
+            if trail is not None:
+                trail.save(self, 'str_trail', self.str_trail)
+                trail.save(self, 'str_size', self.str_size)
+                trail.save(self, 'str_masks', self.str_masks)
+            self.str_size = len(self.str_rows)
+            self.str_masks = None
+            self.str_trail = trail
+
+        masks = [var.cur_domain_mask() for var in self.scope]
+        size = self.str_size
+        last = self.str_masks
+        if last is None:
+            s_val = list(range(len(masks)))
+        else:
+            s_val = [i for i, m in enumerate(masks) if m != last[i]]
+
+        rows = self.str_rows
+        s_sup = list(range(len(masks)))
+        sup = [0] * len(masks)
+        i = 0
+        while i < size:
+            row = rows[i]
+            for p in s_val:
+                if not row[p] & masks[p]:
+                    size -= 1
+                    rows[i], rows[size] = rows[size], row
+                    break
+            else:
+                full = False
+                for p in s_sup:
+                    sup[p] |= row[p]
+                    if sup[p] == masks[p]:
+                        full = True
+                if full:
+                    #every value of these variables now has a support
+                    s_sup = [p for p in s_sup if sup[p] != masks[p]]
+                i += 1
+
+        if s_val and trail is not None:
+            trail.save(self, 'str_size', self.str_size)
+            trail.save(self, 'str_masks', self.str_masks)
+            self.str_size = size
+            self.str_masks = masks
+
+        unsupported = []
+        for p in s_sup:
+            lost = masks[p] & ~sup[p]
+            if lost:
+                var = self.scope[p]
+                for val in var.dom:
+                    if var.bits[val] & lost:
+                        unsupported.append((var, val))
+                        lost &= ~var.bits[val]
+        return unsupported
+
+    def ct_union(self, i, mask):
+        '''Internal routine. Return the mask of tuples whose value at
+           scope position i is one of the values set in mask'''
+        supports = self.ct_supports[i]
+        union = 0
+        while mask:
+            bit = mask & -mask
+            union |= supports.get(bit, 0)
+            mask ^= bit
+        return union
+
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class TupleTable:
+    '''A table of satisfying tuples indexed by position, so that it can
+       be shared by every constraint over the same relation:
+
+       tuples      the distinct tuples, in the order they were added;
+                   tuple k is bit k of the masks
+       sat_tuples  dict with the tuples as keys, for membership tests
+       sup_tuples  per position: {value: list of the tuples with that
+                   value at that position}
+
+       The compact-table masks (see get_masks) and the bit encoded rows
+       used by STR (see get_bit_rows) are built on first use and
+       shared as well. Code that only needs the size, the arity, the
+       masks or membership tests should use len(), arity, get_masks
+       and contains: subclasses (see table_store.MappedTable) can answer
+       those without listing the tuples.
+
+       A table handed out to several constraints is marked shared and
+       must not be modified any more.'''
+
+    def __init__(self, tuples=[]):
+        self.tuples = []
+        self.sat_tuples = dict()
+        self.sup_tuples = []
+        self.arity = None
+        self.matrix = None         #see MatrixTable
+        self.masks = None
+        self.bit_rows = dict()     #bit maps of the scope --> encoded rows
+        self.shared = False
+        self.add_tuples(tuples)
+
+    def add_tuples(self, tuples):
+        '''Add tuples (any iterable of sequences) to the table'''
+        for x in tuples:
+            t = tuple(x)  #ensure we have an immutable tuple
+            if t in self.sat_tuples:
+                continue
+            self.sat_tuples[t] = True
+            self.tuples.append(t)
+            self.arity = len(t)
+            while len(self.sup_tuples) < len(t):
+                self.sup_tuples.append(dict())
+            for i, val in enumerate(t):
+                sup = self.sup_tuples[i].get(val)
+                if sup is None:
+                    sup = self.sup_tuples[i][val] = []
+                sup.append(t)
+        self.masks = None
+        self.bit_rows = dict()
+
+    def __len__(self):
+        return len(self.tuples)
+
+    def contains(self, vals):
+        '''Return True if the sequence vals is one of the tuples'''
+        return tuple(vals) in self.sat_tuples
+
+    def copy(self):
+        '''Return an unshared copy of the table'''
+        return TupleTable(self.tuples)
+
+    def get_masks(self):
+        '''Return, per position, {value: bitmask of the tuples having
+           that value at that position}'''
+        if self.masks is None:
+            nbytes = (len(self.tuples) + 7) // 8
+            arrays = [dict() for sup in self.sup_tuples]
+            for k, t in enumerate(self.tuples):
+                byte = k >> 3
+                bit = 1 << (k & 7)
+                for i, val in enumerate(t):
+                    ba = arrays[i].get(val)
+                    if ba is None:
+                        ba = arrays[i][val] = bytearray(nbytes)
+                    ba[byte] |= bit
+            self.masks = [dict((val, int.from_bytes(ba, 'little')) for val, ba in a.items())
+                          for a in arrays]
+        return self.masks
+
+    def get_bit_rows(self, bit_maps):
+        '''Return the tuples with the value at each position i replaced
+           by bit_maps[i][value] (a variable's bits dict, 0 for values
+           not in it). The rows are cached for each distinct bit_maps.'''
+        key = tuple(tuple(sorted(bits.items())) for bits in bit_maps)
+        rows = self.bit_rows.get(key)
+        if rows is None:
+            rows = [tuple(bits.get(val, 0) for bits, val in zip(bit_maps, t))
+                    for t in self.tuples]
+            self.bit_rows[key] = rows
+        return rows
+
+    def size_bytes(self):
+        '''Rough estimate of the memory used by the table'''
+        if not self.tuples:
+            return 0
+        return TupleTable.estimate_bytes(len(self.tuples), self.arity)
+
+    @staticmethod
+    def estimate_bytes(ntuples, arity):
+        '''Rough estimate of the memory used by a table of ntuples
+           tuples of the given arity'''
+        # tuple objects, sat_tuples entry, sup_tuples references, masks
+        per_tuple = 56 + 8 * arity + 64 + 8 * arity + arity // 4
+        return ntuples * per_tuple
+
+class MatrixTable(TupleTable):
+    '''A TupleTable whose tuples are kept as the rows of a 2D NumPy
+       array of uint8 values (so the values must be integers 0..255,
+       as the nonogram cell values are), instead of as Python tuples
+       referenced from sat_tuples and from every sup_tuples list.
+
+       Constraint.revise_scope works directly on the array, and the
+       rows of Constraint.str_revise are read off it too. tuples,
+       sat_tuples and sup_tuples are only built, from the array, if
+       some code asks for them. Requires NumPy.'''
+
+    def __init__(self, tuples, arity):
+        '''tuples is an iterable of distinct sequences of length arity'''
+        flat = np.fromiter(itertools.chain.from_iterable(tuples), dtype=np.uint8)
+        self.matrix = flat.reshape(-1, arity)
+        self.arity = arity if len(self.matrix) else None
+        self.masks = None
+        self.bit_rows = dict()
+        self.bit_matrices = dict()  #bit maps of the scope --> bit matrix
+        self.shared = False
+        self.decoded = None         #TupleTable of the rows
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @property
+    def tuples(self):
+        return self.get_decoded().tuples
+
+    @property
+    def sat_tuples(self):
+        return self.get_decoded().sat_tuples
+
+    @property
+    def sup_tuples(self):
+        return self.get_decoded().sup_tuples
+
+    def get_decoded(self):
+        '''Internal routine. Return the rows as a TupleTable, built the
+           first time.'''
+        if self.decoded is None:
+            self.decoded = TupleTable(map(tuple, self.matrix.tolist()))
+        return self.decoded
+
+    def add_tuples(self, tuples):
+        print("Trying to add tuples to a MatrixTable")
+
+    def contains(self, vals):
+        if len(vals) != self.arity:
+            return False
+        return bool((self.matrix == np.array(vals)).all(axis=1).any())
+
+    def get_masks(self):
+        if self.masks is None:
+            self.masks = []
+            for column in self.matrix.T:
+                masks = dict()
+                for val in np.unique(column).tolist():
+                    packed = np.packbits(column == val, bitorder='little')
+                    masks[val] = int.from_bytes(packed.tobytes(), 'little')
+                self.masks.append(masks)
+        return self.masks
+
+    def get_bit_matrix(self, bit_maps):
+        '''Return the matrix with the value in column i replaced by
+           bit_maps[i][value] (0 for values not in it), or None if the
+           bits do not fit in 64 bits. Cached for each distinct
+           bit_maps.'''
+        key = tuple(tuple(sorted(bits.items())) for bits in bit_maps)
+        rows = self.bit_matrices.get(key)
+        if rows is None:
+            top = max([bit for bits in bit_maps for bit in bits.values()] + [0])
+            if top >= 1 << 64:
+                return None
+            dtype = np.uint8 if top < 256 else np.uint64
+            rows = np.empty(self.matrix.shape, dtype)
+            for i, bits in enumerate(bit_maps):
+                lookup = np.zeros(256, dtype)
+                for val, bit in bits.items():
+                    if isinstance(val, int) and 0 <= val < 256:
+                        lookup[val] = bit
+                rows[:, i] = lookup[self.matrix[:, i]]
+            self.bit_matrices[key] = rows
+        return rows
+
+    def get_bit_rows(self, bit_maps):
+        '''TupleTable.get_bit_rows, built from get_bit_matrix (or from
+           the matrix rows if the bits do not fit in 64 bits) rather
+           than from decoded tuples'''
+        key = tuple(tuple(sorted(bits.items())) for bits in bit_maps)
+        rows = self.bit_rows.get(key)
+        if rows is None:
+            matrix = self.get_bit_matrix(bit_maps)
+            if matrix is not None:
+                rows = list(map(tuple, matrix.tolist()))
+            else:
+                rows = [tuple(bits.get(val, 0) for bits, val in zip(bit_maps, t))
+                        for t in self.matrix.tolist()]
+            self.bit_rows[key] = rows
+        return rows
+
+    def size_bytes(self):
+        nbytes = self.matrix.nbytes
+        for rows in self.bit_matrices.values():
+            nbytes += rows.nbytes
+        for rows in self.bit_rows.values():
+            nbytes += len(rows) * (56 + 8 * self.matrix.shape[1])
+        if self.masks is not None:
+            nbytes += 2 * len(self.matrix) * self.matrix.shape[1] // 8
+        if self.decoded is not None:
+            nbytes += self.decoded.size_bytes()
+        return nbytes
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -310,12 +1076,19 @@ class CSP:
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        self.neighbours = dict()   #var --> set of the vars sharing a constraint with it
+        self.aux_vars = set()
+        self.order_index = None    #index kept by the variable ordering (see orderings)
         for v in vars:
             self.add_var(v)
 
-    def add_var(self,v):
+    def add_var(self,v,aux=False):
         '''Add variable object to CSP while setting up an index
-           to obtain the constraints over this variable'''
+           to obtain the constraints over this variable. Auxiliary
+           variables (aux=True) are ones the other variables determine,
+           e.g. through channeling constraints: they are only offered
+           to the search (see get_all_unasgn_vars) once every other
+           variable is assigned.'''
         if not type(v) is Variable:
             print("Trying to add non variable ", v, " to CSP object")
         elif v in self.vars_to_cons:
@@ -323,20 +1096,46 @@ class CSP:
         else:
             self.vars.append(v)
             self.vars_to_cons[v] = []
+            self.neighbours[v] = set()
+            if aux:
+                self.aux_vars.add(v)
 
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
            constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
                 if not v in self.vars_to_cons:
                     print("Trying to add constraint ", c, " with unknown variables to CSP object")
                     return
+            for i, v in enumerate(c.scope):
                 self.vars_to_cons[v].append(c)
+                v.watchers.append((c, i))
+                self.neighbours[v].update(c.scope)
+                self.neighbours[v].discard(v)
             self.cons.append(c)
 
+    def replace_constraint(self, old, new):
+        '''Put constraint new, over the same scope as constraint old, in
+           the place of old in the CSP and in the watchers of its
+           variables. An ordering index built over old is made stale,
+           so that it is rebuilt over new (see orderings.get_index).'''
+        if new.scope != old.scope:
+            print("Trying to replace constraint ", old, " by ", new, " over another scope")
+            return
+        self.cons[self.cons.index(old)] = new
+        for i, v in enumerate(old.scope):
+            cons = self.vars_to_cons[v]
+            if old in cons:
+                cons[cons.index(old)] = new
+            v.watchers[v.watchers.index((old, i))] = (new, i)
+            if v.order_index is not None:
+                v.order_index.stale = True
+        if self.order_index is not None:
+            self.order_index.stale = True
+
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
         return self.cons
@@ -345,14 +1144,84 @@ class CSP:
         '''return list of constraints that include var in their scope'''
         return list(self.vars_to_cons[var])
 
+    def get_neighbours(self, var):
+        '''return the set of variables sharing at least one constraint
+           with var, i.e. var's neighbours in the constraint graph. The
+           set is kept up to date by add_constraint and must not be
+           modified.'''
+        return self.neighbours[var]
+
     def get_all_vars(self):
         '''return list of variables in the CSP'''
         return list(self.vars)
 
     def get_all_unasgn_vars(self):
-        '''return list of unassigned variables in the CSP'''
+        '''return list of unassigned variables in the CSP. Auxiliary
+           variables are left out while any other variable is
+           unassigned.'''
+        if self.aux_vars:
+            vs = [v for v in self.vars if not v.is_assigned() and v not in self.aux_vars]
+            if vs:
+                return vs
         return [v for v in self.vars if not v.is_assigned()]
 
+    def get_components(self):
+        '''return the unassigned variables with more than one value left
+           in their current domain, split into connected components: two
+           such variables are in the same component if a chain of
+           constraints links them through such variables. Variables
+           with a single value left do not link components, as their
+           value is already decided, so no constraint ties the values of
+           variables in different components.'''
+        parent = dict()
+        for v in self.vars:
+            if not v.is_assigned() and v.cur_domain_size() > 1:
+                parent[v] = v
+
+        def find(v):
+            while parent[v] is not v:
+                parent[v] = parent[parent[v]]
+                v = parent[v]
+            return v
+
+        for c in self.cons:
+            root = None
+            for v in c.scope:
+                if v in parent:
+                    if root is None:
+                        root = find(v)
+                    else:
+                        parent[find(v)] = root
+
+        components = dict()
+        for v in self.vars:
+            if v in parent:
+                components.setdefault(find(v), []).append(v)
+        return list(components.values())
+
+    def sub_csp(self, name, vars):
+        '''return a CSP over vars (e.g. one of get_components) sharing
+           this CSP's variable and constraint objects: its constraints
+           are the ones over some variable of vars. The other variables
+           of their scopes are not variables of the new CSP, so they
+           should be assigned, or have a single value left, when it is
+           searched.'''
+        sub = CSP(name)
+        sub.vars = list(vars)
+        sub.aux_vars = self.aux_vars.intersection(vars)
+        sub.neighbours = self.neighbours
+        in_sub = set()
+        for v in vars:
+            for c in self.vars_to_cons[v]:
+                if c not in in_sub:
+                    in_sub.add(c)
+                    sub.cons.append(c)
+        for c in sub.cons:
+            for v in c.scope:
+                if v not in sub.vars_to_cons:
+                    sub.vars_to_cons[v] = [c_prime for c_prime in self.vars_to_cons[v] if c_prime in in_sub]
+        return sub
+
     def print_all(self):
         print("CSP", self.name)
         print("   Variables = ", self.vars)
@@ -365,6 +1234,120 @@ class CSP:
             print(v, " = ", v.get_assigned_value(), "    ", end='')
         print("")
 
+########################################################
+# Trail                                                #
+########################################################
+
+class Trail:
+    '''Undo stack for the reversible state of a search.
+
+       Entries are triples (obj, a, b) stored flat in one preallocated
+       list (grown by doubling when full); undoing an entry calls
+       obj.trail_undo(a, b). Variable.prune_value records every pruning
+       on the active trail, and constraints can record their own
+       reversible attributes with save().
+
+       Search takes a checkpoint() before each decision and calls
+       backtrack(mark) to undo everything recorded since.'''
+
+    #The trail domain changes are recorded on (set by BT during search)
+    active = None
+
+    def __init__(self, size=1024):
+        self.entries = [None] * (3 * size)
+        self.top = 0
+        self.nPrunes = 0        #number of prunings recorded
+
+    def push(self, obj, a, b):
+        '''Record an entry undone by obj.trail_undo(a, b)'''
+        top = self.top
+        entries = self.entries
+        if top == len(entries):
+            entries.extend([None] * len(entries))
+        entries[top] = obj
+        entries[top+1] = a
+        entries[top+2] = b
+        self.top = top + 3
+
+    def push_prune(self, var, val):
+        '''Record that val was pruned from var's current domain'''
+        self.push(var, val, None)
+        self.nPrunes += 1
+
+    def push_prune_mask(self, var, mask, n):
+        '''Record that the n values in mask were pruned from var's
+           current domain'''
+        self.push(var, None, mask)
+        self.nPrunes += n
+
+    def save(self, obj, attr, old):
+        '''Record the old value of obj.attr, restored on backtrack'''
+        self.push(obj, attr, old)
+
+    def checkpoint(self):
+        '''Return a mark to backtrack to'''
+        return self.top
+
+    def backtrack(self, mark):
+        '''Undo every entry recorded since checkpoint mark was taken,
+           most recent first'''
+        entries = self.entries
+        top = self.top
+        while top > mark:
+            top -= 3
+            entries[top].trail_undo(entries[top+1], entries[top+2])
+            entries[top] = entries[top+1] = entries[top+2] = None
+        self.top = top
+
+    def clear(self):
+        '''Forget every entry without undoing it'''
+        for i in range(self.top):
+            self.entries[i] = None
+        self.top = 0
+        self.nPrunes = 0
+
+class PropagationEngine:
+    '''Worklist of constraints waiting to be revised.
+
+       While an engine is active every domain change event a variable
+       sends (see Variable.notify) schedules the constraints watching
+       that variable. For each queued constraint the engine remembers
+       which of its variables changed since it was queued (None if the
+       whole scope has to be revised), so a revision can skip what the
+       change cannot have affected. Membership tests and queue
+       operations are O(1).'''
+
+    #The engine events are scheduled on (set by propagators while running)
+    active = None
+
+    def __init__(self, cons=[], changed_var=None):
+        '''Queue cons, all of them because of a change to changed_var
+           (None to revise their whole scope)'''
+        self.queue = deque()
+        self.pending = dict()   #queued constraint --> set of changed variables
+        for c in cons:
+            if not c in self.pending:
+                self.queue.append(c)
+                self.pending[c] = None if changed_var is None else {changed_var}
+
+    def schedule(self, c, var):
+        '''Queue c for revision because var changed'''
+        changed = self.pending.get(c, False)
+        if changed is False:
+            self.queue.append(c)
+            self.pending[c] = {var}
+        elif changed is not None:
+            changed.add(var)
+
+    def pop(self):
+        '''Return the next constraint to revise and the set of its
+           variables that changed (None if all of them must be revised)'''
+        c = self.queue.popleft()
+        return c, self.pending.pop(c)
+
+    def __len__(self):
+        return len(self.queue)
+
 ########################################################
 # Backtracking Routine                                 #
 ########################################################
@@ -386,8 +1369,12 @@ class BT:
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
         unasgn_vars = list() #used to track unassigned variables
+        self.trail = Trail() #undo stack for the prunings made during search
         self.TRACE = False
         self.runtime = 0
+        #search the independent components left after root
+        #propagation one at a time (see bt_components)
+        self.split_components = True
 
     def trace_on(self):
         '''Turn search trace on'''
@@ -408,9 +1395,26 @@ class BT:
         print("Search made {} variable assignments and pruned {} variable values".format(
             self.nDecisions, self.nPrunings))
 
+    def reset(self):
+        '''Get ready to search the CSP again, e.g. once its constraints
+           have been given new tables (see nonogram_csp.ModelTemplate):
+           clear the statistics, unassign every variable and restore
+           its domain, empty the trail, keeping the storage it has
+           grown to, and reset the constraint weights. The ordering
+           index keyed by the old state is made stale, so it is rebuilt
+           by the next pick (see orderings.get_index).'''
+        self.clear_stats()
+        for c in self.csp.cons:
+            c.weight = 1
+        self.restore_all_variable_domains()
+        self.trail.clear()
+        if self.csp.order_index is not None:
+            self.csp.order_index.stale = True
+
     def restoreValues(self,prunings):
         '''Restore list of values to variable domains
-           each item in prunings is a pair (var, val)'''
+           each item in prunings is a pair (var, val). bt_search undoes
+           prunings through its trail instead.'''
         for var, val in prunings:
             var.unprune_value(val)
 
@@ -451,8 +1455,11 @@ class BT:
 
            The list of variable values pairs are all of the values
            the propagator pruned (using the variable's prune_value method). 
-           bt_search NEEDS to know this in order to correctly restore these 
-           values when it undoes a variable assignment.
+           During search every prune_value call is recorded on the
+           trail (self.trail), which is what bt_search uses to restore
+           these values when it undoes a variable assignment; the list
+           is kept for compatibility and tracing. Propagators may also
+           record reversible state of their own with Trail.active.save.
 
            NOTE propagator SHOULD NOT prune a value that has already been 
            pruned! Nor should it prune a value twice
@@ -461,10 +1468,10 @@ class BT:
            val_ord is the value ordering function currently being used.
            '''
 
-        self.clear_stats()
+        self.reset()
         stime = time.process_time()
 
-        self.restore_all_variable_domains()
+        Trail.active = self.trail
         
         self.unasgn_vars = []
         for v in self.csp.vars:
@@ -472,20 +1479,27 @@ class BT:
                 self.unasgn_vars.append(v)
 
         status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
+        self.nPrunings = self.trail.nPrunes
 
         if self.TRACE:
             print(len(self.unasgn_vars), " unassigned variables at start of search")
             print("Root Prunings: ", prunings)
 
+        if status and (self.TRACE or prunings):
+            #only report when the root pass actually pruned something
+            nFixed = sum(1 for v in self.unasgn_vars if v.cur_domain_size() == 1)
+            print("Root propagation fixed {} of {} variables, {} remain".format(
+                nFixed, len(self.unasgn_vars), len(self.unasgn_vars) - nFixed))
+
         if status == False:
             print("CSP{} detected contradiction at root".format(
                 self.csp.name))
         else:
-            status = self.bt_recurse(propagator, var_ord,val_ord, 1)   #now do recursive search
+            status = self.bt_components(propagator, var_ord, val_ord)   #now do the search
 
 
-        self.restoreValues(prunings)
+        self.trail.backtrack(0)
+        Trail.active = None
         if status == False:
             print("CSP{} unsolved. Has no solutions".format(self.csp.name))
         if status == True:
@@ -497,52 +1511,122 @@ class BT:
         self.print_stats()
         return status
 
-    def bt_recurse(self, propagator, var_ord, val_ord, level):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
+    def bt_components(self, propagator, var_ord, val_ord):
+        '''Return true if found solution. False if there is no solution.
+
+           Once root propagation has decided many variables the others
+           often fall into components that share no constraint (see
+           CSP.get_components). A failure in one of them then says
+           nothing about the others, so instead of searching them
+           jointly each component is searched on its own, over a
+           sub_csp, and its solution kept while the next one is
+           searched: the search spaces add up instead of multiplying.
+           The variables with a single value left are assigned first,
+           and the propagator run on each, so that every constraint is
+           checked.'''
+
+        components = self.csp.get_components() if self.split_components else []
+        if len(components) < 2:
+            return self.bt_iterate(propagator, var_ord, val_ord)
 
         if self.TRACE:
-            print('  ' * level, "bt_recurse level ", level)
-           
+            print("Searching {} independent components of {} variables".format(
+                len(components), sorted((len(vs) for vs in components), reverse=True)))
+
+        in_component = set(itertools.chain.from_iterable(components))
+        for var in list(self.unasgn_vars):
+            if var not in in_component:
+                self.unasgn_vars.remove(var)
+                var.assign(var.cur_domain()[0])
+                status, prunings = propagator(self.csp, var)
+                self.nPrunings = self.trail.nPrunes
+                if not status:
+                    return False
+
+        for i, vs in enumerate(components):
+            sub = self.csp.sub_csp("{}.{}".format(self.csp.name, i), vs)
+            self.unasgn_vars = [v for v in vs if not v.is_assigned()]
+            if self.TRACE:
+                print("bt_components searching component", i, "of", len(self.unasgn_vars), "variables")
+            if not self.bt_iterate(propagator, var_ord, val_ord, sub):
+                return False
+        return True
+
+    def bt_iterate(self, propagator, var_ord, val_ord, csp=None):
+        '''Return true if found solution. False if there is no solution.
+
+           Depth first search driven by an explicit stack rather than
+           recursion, so the depth is not bounded by Python's recursion
+           limit. Each stack entry is a search level:
+               [var, value_order, index of next value to try, mark]
+           where mark is the trail checkpoint taken before assigning the
+           value currently being tried (None if no value is assigned).
+
+           csp is the CSP to search (by default self.csp); its
+           unassigned variables must be those in self.unasgn_vars.'''
+
+        if csp is None:
+            csp = self.csp
         if not self.unasgn_vars:
             #all variables assigned
             return True
-        else:
-            ##Figure out which variable to assign,
-            ##Then remove it from the list of unassigned vars
-            var = var_ord(self.csp)
-            #print ('Removing: ' + str(var))
-            self.unasgn_vars.remove(var) 
+
+        stack = [self.new_level(csp, var_ord, val_ord, 1)]
+        while stack:
+            level = len(stack)
+            frame = stack[-1]
+            var, value_order, index, mark = frame
+
+            if mark is not None:
+                #undo the value tried last at this level
+                if self.TRACE:
+                    print('  ' * level, "bt_iterate restoring to ", mark)
+                self.trail.backtrack(mark)
+                var.unassign()
+                frame[3] = None
+
+            if index == len(value_order):
+                #no values left, backtrack to the previous level
+                self.restoreUnasgnVar(var)
+                stack.pop()
+                continue
+
+            val = value_order[index]
+            frame[2] = index + 1
 
             if self.TRACE:
-                print('  ' * level, "bt_recurse var = ", var)
+                print('  ' * level, "bt_iterate trying", var, "=", val)
 
-            value_order = val_ord(self.csp,var)
+            frame[3] = self.trail.checkpoint()
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
 
-            for val in value_order:
-                #print('Assigning ' + str(val))
+            status, prunings = propagator(csp, var)
+            self.nPrunings = self.trail.nPrunes
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse trying", var, "=", val)
+            if self.TRACE:
+                print('  ' * level, "bt_iterate prop status = ", status)
+                print('  ' * level, "bt_iterate prop pruned = ", prunings)
 
-                var.assign(val)
-                self.nDecisions = self.nDecisions+1
+            if status:
+                if not self.unasgn_vars:
+                    #all variables assigned
+                    return True
+                stack.append(self.new_level(csp, var_ord, val_ord, level+1))
 
-                status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+        return False
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+    def new_level(self, csp, var_ord, val_ord, level):
+        '''Internal routine of bt_iterate. Pick the next variable to
+           assign, remove it from the list of unassigned vars and return
+           the new stack entry for it.'''
+        if self.TRACE:
+            print('  ' * level, "bt_iterate level ", level)
 
-                if status:
-                    if self.bt_recurse(propagator, var_ord,val_ord, level+1):
-                        return True
+        var = var_ord(csp)
+        self.unasgn_vars.remove(var)
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
-                var.unassign()
+        if self.TRACE:
+            print('  ' * level, "bt_iterate var = ", var)
 
-            self.restoreUnasgnVar(var)
-            return False
+        return [var, val_ord(csp, var), 0, None]
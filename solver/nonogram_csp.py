@@ -7,8 +7,26 @@ Construct and return nonogram CSP models.
 
 from cspbase import *
 import itertools
+from collections import OrderedDict, deque
+from math import comb
 
-def nonogram_csp_model(nonogram_rows, nonogram_columns):
+#Lines whose table is projected to take more than TABLE_BUDGET bytes are
+#given a LineConstraint instead. If BUILD_REPORT is True the model
+#builder prints the tuple count and projected table size of every line.
+TABLE_BUDGET = 64 * 1024 * 1024
+BUILD_REPORT = False
+
+#If PRESOLVE is True nonogram_csp_model first decides what it can from
+#the clues alone (see presolve) and builds a CSP over the other cells.
+PRESOLVE = False
+
+#If USE_TEMPLATES is True nonogram_csp_model (without PRESOLVE) builds
+#one ModelTemplate per grid shape, kept in TEMPLATES, and binds the
+#clues of each puzzle of that shape to it.
+USE_TEMPLATES = False
+TEMPLATES = dict()     #(rows, columns) --> ModelTemplate
+
+def nonogram_csp_model(nonogram_rows, nonogram_columns, line_constraints=False):
     '''Return a CSP object representing a nonogram CSP problem along 
        with an array of variables for the problem. That is return
 
@@ -24,14 +42,45 @@ def nonogram_csp_model(nonogram_rows, nonogram_columns):
        This routine returns a model which consists of a variable for
        each cell of the board, with domain equal to {0,1}, with 0 being
        not coloured and 1 being coloured.
+
+       If line_constraints is True each row and column is a
+       LineConstraint over its clue instead of a table of every legal
+       placement. Otherwise the number of placements of every line is
+       computed first (see line_tuple_count) and lines whose table
+       would go over TABLE_BUDGET bytes get a LineConstraint anyway.
+
+       If PRESOLVE is True the cells the clues alone decide (see
+       presolve) are assigned up front and left out of the CSP: the
+       constraints are only over the undecided cells of each line, the
+       tables only hold the placements agreeing with the decided ones,
+       and fully decided lines get no constraint at all.
+
+       If USE_TEMPLATES is True (and PRESOLVE is not) the CSP and the
+       variables are those of the ModelTemplate of the grid shape,
+       shared by every puzzle of that shape: a new call rebinds them.
     '''
 
     n = len(nonogram_rows)
     m = len(nonogram_columns)
 
+    if USE_TEMPLATES and not PRESOLVE:
+        template = TEMPLATES.get((n, m))
+        if template is None:
+            template = TEMPLATES[(n, m)] = ModelTemplate(n, m)
+        return template.bind(nonogram_rows, nonogram_columns, line_constraints)
+
     # Create CSP object
     nonogram_csp = CSP("Model_david")
 
+    known = None
+    if PRESOLVE:
+        known = presolve(nonogram_rows, nonogram_columns)
+        if known is None:
+            print("Presolve found the clues contradictory")
+        else:
+            n_known = sum(1 for row in known for val in row if val is not None)
+            print("Presolve decided {} of {} cells".format(n_known, n * m))
+
     # Create variable array
     # variable_array[i][j] corresponds to the row i column j cell
     variable_array = []
@@ -39,67 +88,1068 @@ def nonogram_csp_model(nonogram_rows, nonogram_columns):
         variable_array.append([])
         for j in range(0, m):
             name = 'V' + str(i+1) + "," + str(j+1)
+            if known is not None and known[i][j] is not None:
+                # decided by the presolve
+                var = Variable(name, [known[i][j]])
+                var.assign(known[i][j])
+                variable_array[i].append(var)
+                continue
             variable_array[i].append(Variable(name, [0, 1]))
             nonogram_csp.add_var(variable_array[i][j])
 
-    # Create constraints
+    # Collect the lines
+    lines = []
     # Row constraints
     for i in range(0, n): # row index
         name = 'Row ' + str(i)
-        constraint = Constraint(name, [variable_array[i][j] for j in range(0, m)])
-        valid_tuples = []
-        get_valid_nary_tuples(m, nonogram_rows[i], valid_tuples)
-        constraint.add_satisfying_tuples(valid_tuples)
-        nonogram_csp.add_constraint(constraint)
+        scope = [variable_array[i][j] for j in range(0, m)]
+        line_known = [known[i][j] for j in range(0, m)] if known else None
+        lines.append((name, scope, nonogram_rows[i], line_known))
     
     # Column constraints
     for i in range(0, m): # column index
         name = 'Column ' + str(i)
-        constraint = Constraint(name, [variable_array[j][i] for j in range(0, n)])
-        valid_tuples = []
-        get_valid_nary_tuples(n, nonogram_columns[i], valid_tuples)
-        constraint.add_satisfying_tuples(valid_tuples)
-        nonogram_csp.add_constraint(constraint)
+        scope = [variable_array[j][i] for j in range(0, n)]
+        line_known = [known[j][i] for j in range(0, n)] if known else None
+        lines.append((name, scope, nonogram_columns[i], line_known))
+
+    # Create constraints, deciding per line whether its table fits
+    report = []
+    for name, scope, clue, line_known in lines:
+        if line_known is not None and all(val is None for val in line_known):
+            line_known = None
+        if line_known is None:
+            count = line_tuple_count(len(scope), clue)
+        else:
+            scope = [var for var, val in zip(scope, line_known) if val is None]
+            if not scope:
+                # fully decided line
+                continue
+            count = line_known_counts(clue, line_known)[0][0]
+        nbytes = TupleTable.estimate_bytes(count, len(scope))
+        use_line = line_constraints or nbytes > TABLE_BUDGET
+        report.append((name, len(scope), clue, count, nbytes, use_line))
+        nonogram_csp.add_constraint(make_line_constraint(name, scope, clue, use_line, line_known))
+
+    report_lines(report, line_constraints)
 
     return nonogram_csp, variable_array
 
 
-def get_valid_nary_tuples(_span, _constraint, valid_tuples, current_tuple=[]):
-    # If empty row, convert to empty list consistent with algo
-    if(_constraint == [0]):
-        _constraint = []
+def nonogram_csp_model2(nonogram_rows, nonogram_columns):
+    '''Same cell model as nonogram_csp_model, but with every row and
+       column represented by a LineConstraint, so no placements are
+       enumerated while building the model.
+    '''
+    return nonogram_csp_model(nonogram_rows, nonogram_columns, line_constraints=True)
+
+
+class ModelTemplate:
+    '''The CSP of nonogram_csp_model for one grid shape, without its
+       clues: the cell variables, the scope of every row and column and
+       the CSP's variable to constraint index are built once, and bind
+       turns them into the model of any puzzle of that shape by giving
+       each line constraint the table (or clue) of its line. Batches of
+       puzzles of one shape then skip building the model, and a BT over
+       the template's CSP can be reused for all of them (see BT.reset).
+
+       Each line keeps a table constraint and a LineConstraint, made
+       the first time they are needed, and the one bind picks for the
+       line is the one in the CSP.'''
+
+    def __init__(self, n, m):
+        '''Build the template of grids with n rows and m columns'''
+        self.csp = CSP("Model_david")
+
+        self.variable_array = []
+        for i in range(0, n):
+            self.variable_array.append([])
+            for j in range(0, m):
+                var = Variable('V' + str(i+1) + "," + str(j+1), [0, 1])
+                self.variable_array[i].append(var)
+                self.csp.add_var(var)
+
+        self.lines = []        #per line: [table constraint, LineConstraint]
+        for i in range(0, n):
+            scope = [self.variable_array[i][j] for j in range(0, m)]
+            self.lines.append([Constraint('Row ' + str(i), scope), None])
+        for i in range(0, m):
+            scope = [self.variable_array[j][i] for j in range(0, n)]
+            self.lines.append([Constraint('Column ' + str(i), scope), None])
+        for table_con, line_con in self.lines:
+            self.csp.add_constraint(table_con)
+        self.cons = [table_con for table_con, line_con in self.lines]
+
+    def bind(self, nonogram_rows, nonogram_columns, line_constraints=False):
+        '''Make the template the model of the puzzle with the given
+           clues, which must fit its shape, deciding for every line
+           between a table and a LineConstraint as nonogram_csp_model
+           does. Every variable is unassigned and its domain restored.
+           Returns nonogram_csp, variable_array.'''
+        clues = list(nonogram_rows) + list(nonogram_columns)
+        report = []
+        for k, clue in enumerate(clues):
+            table_con, line_con = self.lines[k]
+            span = len(table_con.scope)
+            count = line_tuple_count(span, clue)
+            nbytes = TupleTable.estimate_bytes(count, span)
+            use_line = line_constraints or nbytes > TABLE_BUDGET
+            report.append((table_con.name, span, clue, count, nbytes, use_line))
+            if use_line:
+                if line_con is None:
+                    line_con = self.lines[k][1] = LineConstraint(table_con.name, table_con.scope, clue)
+                else:
+                    line_con.set_clue(clue)
+                c = line_con
+            else:
+                table_con.set_table(TABLE_CACHE.get(span, clue))
+                c = table_con
+            if c is not self.cons[k]:
+                self.csp.replace_constraint(self.cons[k], c)
+                self.cons[k] = c
+
+        for var in self.csp.vars:
+            if var.is_assigned():
+                var.unassign()
+            var.restore_curdom()
+
+        report_lines(report, line_constraints)
+        return self.csp, self.variable_array
+
+
+def nonogram_csp_model3(nonogram_rows, nonogram_columns):
+    '''Dual model: every row and column is also a variable whose domain
+       is the set of placements of its clue (the indexes of the
+       placements in the line table, see line_tuples), channeled to
+       each cell of the line by a ChannelConstraint. The cells are
+       auxiliary variables, so the search branches on the placement of
+       whole lines and MRV picks the line with the fewest placements
+       left.
+
+       A line whose table would go over TABLE_BUDGET bytes gets no
+       variable; a LineConstraint over its cells is used instead.
+
+       Returns nonogram_csp, variable_array like nonogram_csp_model.
+    '''
+
+    n = len(nonogram_rows)
+    m = len(nonogram_columns)
+
+    nonogram_csp = CSP("Model_dual")
+
+    # Create cell variable array, as in nonogram_csp_model
+    variable_array = []
+    for i in range(0, n):
+        variable_array.append([])
+        for j in range(0, m):
+            name = 'V' + str(i+1) + "," + str(j+1)
+            variable_array[i].append(Variable(name, [0, 1]))
+
+    lines = []
+    for i in range(0, n):
+        lines.append(('Row ' + str(i), [variable_array[i][j] for j in range(0, m)], nonogram_rows[i]))
+    for i in range(0, m):
+        lines.append(('Column ' + str(i), [variable_array[j][i] for j in range(0, n)], nonogram_columns[i]))
+
+    # Line variables
+    channels = []
+    line_cons = []
+    for name, scope, clue in lines:
+        count = line_tuple_count(len(scope), clue)
+        if TupleTable.estimate_bytes(count, len(scope)) > TABLE_BUDGET:
+            line_cons.append(LineConstraint(name, scope, clue))
+            continue
+        line_var = Variable(name, range(count))
+        nonogram_csp.add_var(line_var)
+        for j, black in enumerate(line_masks(len(scope), clue)):
+            channels.append(ChannelConstraint(name + ' cell ' + str(j), line_var, scope[j], black))
+
+    for row in variable_array:
+        for var in row:
+            nonogram_csp.add_var(var, aux=True)
+    for c in channels + line_cons:
+        nonogram_csp.add_constraint(c)
+
+    return nonogram_csp, variable_array
+
+
+def nonogram_csp_model4(nonogram_rows, nonogram_columns):
+    '''Block-start model: every block of every clue is a variable whose
+       value is the cell the block starts at (from its leftmost to its
+       rightmost possible start). Each row and column is one
+       BlockLineConstraint over its blocks and its cells, which prunes
+       both cell values and block starts with the line dynamic program
+       (see line_block_supports).
+
+       The model has O(blocks x span) variable values, and revising a
+       line takes O(blocks x span) time, however many placements the
+       clues have, so it can be built and solved for puzzles whose
+       tables could never be enumerated.
+
+       Returns nonogram_csp, variable_array like nonogram_csp_model.
+    '''
+
+    n = len(nonogram_rows)
+    m = len(nonogram_columns)
+
+    nonogram_csp = CSP("Model_blocks")
+
+    # Create cell variable array, as in nonogram_csp_model
+    variable_array = []
+    for i in range(0, n):
+        variable_array.append([])
+        for j in range(0, m):
+            name = 'V' + str(i+1) + "," + str(j+1)
+            variable_array[i].append(Variable(name, [0, 1]))
+
+    lines = []
+    for i in range(0, n):
+        lines.append(('Row ' + str(i), [variable_array[i][j] for j in range(0, m)], nonogram_rows[i]))
+    for i in range(0, m):
+        lines.append(('Column ' + str(i), [variable_array[j][i] for j in range(0, n)], nonogram_columns[i]))
+
+    cons = []
+    for name, scope, clue in lines:
+        clue = [] if list(clue) == [0] else list(clue)
+        span = len(scope)
+
+        # Block b starts between its leftmost start (every block before
+        # it packed to the left) and its rightmost one
+        blocks = []
+        for b, length in enumerate(clue):
+            first = sum(clue[:b]) + b
+            last = span - sum(clue[b:]) - (len(clue) - 1 - b)
+            block = Variable(name + ' block ' + str(b), range(first, last + 1))
+            nonogram_csp.add_var(block)
+            blocks.append(block)
+
+        cons.append(BlockLineConstraint(name, blocks, scope, clue))
+
+    for row in variable_array:
+        for var in row:
+            nonogram_csp.add_var(var)
+    for c in cons:
+        nonogram_csp.add_constraint(c)
+
+    return nonogram_csp, variable_array
+
+
+def make_line_constraint(name, scope, clue, line_constraint=False, known=None):
+    '''Return the constraint for one row or column: a LineConstraint if
+       line_constraint is True, otherwise a table constraint holding
+       every legal placement of the clue over the scope.
+
+       If known is given it lists, for every cell of the line, its
+       decided value or None, and scope holds only the undecided
+       cells.'''
+    if line_constraint:
+        return LineConstraint(name, scope, clue, known)
+    constraint = Constraint(name, scope)
+    if known is None:
+        constraint.set_table(TABLE_CACHE.get(len(scope), clue))
+    else:
+        constraint.set_table(TABLE_CACHE.get(len(known), clue, known))
+    return constraint
+
+
+def presolve(nonogram_rows, nonogram_columns):
+    '''Decide the cells the clues force before any CSP is built. Each
+       row and column is solved as far as line_supports allows, given
+       the cells decided so far, and the lines crossing newly decided
+       cells are solved again, until nothing changes. This covers the
+       overlap of the leftmost and rightmost packings, full and [0]
+       lines, and clues whose sum plus gaps equals the span, as well as
+       what they imply across rows and columns.
+
+       Returns the grid of decided values (None for undecided cells),
+       or None if some line has no placement left.'''
+    n = len(nonogram_rows)
+    m = len(nonogram_columns)
+    grid = [[None] * m for i in range(n)]
+
+    que = deque([('row', i) for i in range(n)] + [('col', j) for j in range(m)])
+    in_que = set(que)
+    while que:
+        line = que.popleft()
+        in_que.discard(line)
+        kind, index = line
+        if kind == 'row':
+            cells = [(index, j) for j in range(m)]
+            clue = nonogram_rows[index]
+        else:
+            cells = [(i, index) for i in range(n)]
+            clue = nonogram_columns[index]
+        clue = [] if list(clue) == [0] else list(clue)
+
+        vals = [grid[i][j] for i, j in cells]
+        can_white, can_black = line_supports(clue, [val != 1 for val in vals],
+                                             [val != 0 for val in vals])
+        for (i, j), val, w, b in zip(cells, vals, can_white, can_black):
+            if not w and not b:
+                return None
+            if val is None and w != b:
+                grid[i][j] = 1 if b else 0
+                cross = ('col', j) if kind == 'row' else ('row', i)
+                if cross not in in_que:
+                    que.append(cross)
+                    in_que.add(cross)
+    return grid
+
+
+def line_tuple_count(span, clue):
+    '''Return the number of placements of clue on a line of length
+       span, i.e. the number of tuples line_tuples generates: with k
+       blocks and slack free cells it is C(slack + k, k).'''
+    if list(clue) == [0]:
+        clue = []
+    k = len(clue)
+    slack = span - sum(clue) - (k - 1)
+    if k == 0:
+        return 1
+    if slack < 0:
+        return 0
+    return comb(slack + k, k)
+
+
+def report_lines(report, line_constraints):
+    '''Print the build report of a model if BUILD_REPORT is True, and
+       otherwise the lines that went over TABLE_BUDGET (if lines were
+       not all asked to be line constraints)'''
+    if BUILD_REPORT:
+        print_build_report(report)
+    elif not line_constraints:
+        switched = [name for name, span, clue, count, nbytes, use_line in report if use_line]
+        if switched:
+            print("Lines over the table budget, using line constraints:", ", ".join(switched))
+
+
+def print_build_report(report):
+    '''Print, for every line of a model, its tuple count, the projected
+       size of its table and the representation chosen for it. report
+       is a list of (name, span, clue, count, bytes, line constraint
+       used) entries.'''
+    print("{:<12} {:>5} {:>14} {:>11}  {}".format("line", "span", "tuples", "table MB", "constraint"))
+    total_count = 0
+    total_bytes = 0
+    n_line = 0
+    for name, span, clue, count, nbytes, use_line in report:
+        print("{:<12} {:>5} {:>14} {:>11.1f}  {}".format(
+            name, span, count, nbytes / 2**20, "line" if use_line else "table"))
+        if use_line:
+            n_line += 1
+        else:
+            total_count += count
+            total_bytes += nbytes
+    print("{} table lines with {} tuples (~{:.1f} MB before sharing), {} line constraints".format(
+        len(report) - n_line, total_count, total_bytes / 2**20, n_line))
+
+
+class TableCache:
+    '''LRU cache of line tables: TupleTables of every placement of a
+       clue on a line, keyed by (span, tuple(clue), known) where known
+       is None or the tuple of decided cell values (see get). Lines
+       with the same span and clue (within a model, or across the
+       models built in one process) share one table.
+
+       Once the estimated size of the cached tables goes over max_bytes
+       the least recently used ones are dropped. Constraints still
+       using a dropped table keep it alive.
+
+       If store is set (a table_store.TableStore) tables missing from
+       the cache are loaded from it, and tables that had to be
+       generated are saved to it for later runs.
+
+       If matrix is True the tables are MatrixTables (NumPy arrays)
+       rather than TupleTables.'''
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, store=None, matrix=False):
+        self.max_bytes = max_bytes
+        self.store = store
+        self.matrix = matrix
+        self.tables = OrderedDict()     #key --> (TupleTable, size when cached)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, span, clue, known=None):
+        '''Return the (shared) table of placements of clue on a line of
+           length span. If known is given (the decided value, or None,
+           of every cell) the table only holds the placements agreeing
+           with it, restricted to the undecided cells.'''
+        key = (span, tuple(clue), None if known is None else tuple(known))
+        entry = self.tables.get(key)
+        if entry is not None:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            return entry[0]
 
-    span = _span
-    constraint = list(_constraint)
+        self.misses += 1
+        if known is not None:
+            free = [p for p, val in enumerate(known) if val is None]
+            tuples = (tuple(t[p] for p in free) for t in line_tuples_known(clue, known))
+            if self.matrix:
+                table = MatrixTable(tuples, len(free))
+            else:
+                table = TupleTable(tuples)
+            return self.add(key, table)
 
-    if(span == 0):
-        if(len(constraint) == 0):
-            valid_tuples.append(current_tuple)
+        table = None
+        if self.store is not None:
+            table = self.store.load(span, clue)
+        if table is None:
+            if self.matrix:
+                table = MatrixTable(line_tuples(span, clue), span)
+            else:
+                table = TupleTable(line_tuples(span, clue))
+            if self.store is not None:
+                self.store.save(span, clue, table)
+        elif self.matrix:
+            table = MatrixTable(table.iter_rows(), span)
+        return self.add(key, table)
+
+    def add(self, key, table):
+        '''Internal routine. Cache table under key and return it'''
+        table.shared = True
+        #a table's size_bytes grows as masks and views get built, so
+        #the size counted in nbytes is the one recorded here
+        size = table.size_bytes()
+        self.tables[key] = (table, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes and len(self.tables) > 1:
+            old_key, (old, old_size) = self.tables.popitem(last=False)
+            self.nbytes -= old_size
+        return table
+
+    def clear(self):
+        self.tables.clear()
+        self.nbytes = 0
+
+
+#Table cache shared by every model built in this process
+TABLE_CACHE = TableCache()
+
+
+class ChannelConstraint(Constraint):
+    '''Channels a line variable, whose values are the indexes of the
+       placements of its clue, to one cell of the line: the scope is
+       [line_var, cell_var] and placement p requires the cell to be 1
+       exactly if bit p is set in black (the table mask of the
+       placements colouring the cell).
+
+       Value p of line_var has bit 1 << p (its domain is range(N)), so
+       supports are bitmask tests against black and its complement.'''
+
+    def __init__(self, name, line_var, cell_var, black):
+        Constraint.__init__(self, name, [line_var, cell_var])
+        self.black = black
+        self.white = line_var.full_mask & ~black
+
+    def add_satisfying_tuples(self, tuples):
+        print("Trying to add satisfying tuples to channel constraint ", self)
+
+    def check(self, vals):
+        p, val = vals
+        bit = self.scope[0].bits.get(p, 0)
+        return bit != 0 and val == (1 if bit & self.black else 0)
+
+    def has_support(self, var, val):
+        line_var, cell_var = self.scope
+        if var is cell_var:
+            placements = self.black if val == 1 else self.white if val == 0 else 0
+            return line_var.cur_domain_mask() & placements != 0
+        bit = line_var.bits.get(val, 0)
+        if not bit:
+            return False
+        return cell_var.in_cur_domain(1 if bit & self.black else 0)
+
+    def supports_given(self, var, val):
+        line_var, cell_var = self.scope
+        if var is cell_var:
+            placements = self.black if val == 1 else self.white if val == 0 else 0
+            placements &= line_var.cur_domain_mask()
+            return [placements, cell_var.bits.get(val, 0) if placements else 0]
+        bit = line_var.bits.get(val, 0)
+        cell_val = 1 if bit & self.black else 0
+        if not bit or not cell_var.in_cur_domain(cell_val):
+            return [0, 0]
+        return [bit, cell_var.bits[cell_val]]
+
+    def support_count(self, var, val):
+        '''For the cell, the number of placements left that give it
+           val; for the line variable, 1 if placement val agrees with
+           the cell and 0 if not'''
+        line_var, cell_var = self.scope
+        if var is cell_var:
+            placements = self.black if val == 1 else self.white if val == 0 else 0
+            return bin(line_var.cur_domain_mask() & placements).count('1')
+        return 1 if self.has_support(var, val) else 0
+
+    def revise_scope(self):
+        '''Return the (var, val) pairs of the scope without support. All
+           the placements the cell rules out are found with one mask.'''
+        line_var, cell_var = self.scope
+        placements = line_var.cur_domain_mask()
+        unsupported = []
+        lost = 0
+        if cell_var.in_cur_domain(0):
+            if not placements & self.white:
+                unsupported.append((cell_var, 0))
+        else:
+            lost |= placements & self.white
+        if cell_var.in_cur_domain(1):
+            if not placements & self.black:
+                unsupported.append((cell_var, 1))
+        else:
+            lost |= placements & self.black
+        while lost:
+            bit = lost & -lost
+            unsupported.append((line_var, bit.bit_length() - 1))
+            lost ^= bit
+        return unsupported
+
+    def str_revise(self):
+        return self.revise_scope()
+
+
+class LineConstraint(Constraint):
+    '''A nonogram row or column constraint given by its clue instead of
+       a table of satisfying tuples.
+
+       The values of the scope that still have a support are computed
+       together by a forward/backward dynamic program over the current
+       domains (see line_supports), which takes O(span x blocks) time
+       and never enumerates placements. The result is cached until some
+       variable domain changes, and so are the placement counts of
+       support_count, from the counting DP line_block_counts.'''
+
+    def __init__(self, name, scope, clue, known=None):
+        '''If known is given it lists the decided value (or None) of
+           every cell of the line, and scope holds the undecided ones
+           in order'''
+        Constraint.__init__(self, name, scope)
+        self.clue = [] if list(clue) == [0] else list(clue)
+        if known is None:
+            known = [None] * len(self.scope)
+        self.known = list(known)
+        self.positions = [p for p, val in enumerate(self.known) if val is None]
+        self.index = dict((var, i) for i, var in enumerate(self.scope))
+        self.line_sup = None       #per scope position: mask of supported values
+        self.line_stamp = -1       #Variable.stamp line_sup was computed at
+        self.line_count = None     #per scope position: value --> placements giving it
+        self.count_stamp = -1      #Variable.stamp line_count was computed at
+
+    def set_clue(self, clue):
+        '''Make the constraint the one of clue, over the same scope
+           (with no decided cells)'''
+        self.clue = [] if list(clue) == [0] else list(clue)
+        self.known = [None] * len(self.scope)
+        self.positions = list(range(len(self.scope)))
+        self.line_sup = None
+        self.line_stamp = -1
+        self.line_count = None
+        self.count_stamp = -1
+        self.notify_order_index()
+
+    def add_satisfying_tuples(self, tuples):
+        print("Trying to add satisfying tuples to line constraint ", self)
+
+    def check(self, vals):
+        line = list(self.known)
+        for p, val in zip(self.positions, vals):
+            line[p] = val
+        return get_line_clue(line) == self.clue
+
+    def has_support(self, var, val):
+        self.line_refresh()
+        return self.line_sup[self.index[var]] & var.bits.get(val, 0) != 0
+
+    def support_count(self, var, val):
+        '''The number of placements of the clue consistent with the
+           current domains that give var the value val. The counts of
+           every cell come from one run of line_block_counts.'''
+        if self.count_stamp != Variable.stamp:
+            white, black = self.line_cells()
+            n_white, n_black, starts = line_block_counts(self.clue, white, black)
+            self.line_count = [{0: n_white[p], 1: n_black[p]} for p in self.positions]
+            self.count_stamp = Variable.stamp
+        return self.line_count[self.index[var]].get(val, 0)
+
+    def revise_scope(self):
+        '''Return the (var, val) pairs of the scope without support, as
+           Constraint.str_revise does for table constraints. The whole
+           scope is revised by one run of the line DP.'''
+        self.line_refresh()
+        unsupported = []
+        for var, sup in zip(self.scope, self.line_sup):
+            lost = var.cur_domain_mask() & ~sup
+            if lost:
+                for val in var.dom:
+                    if var.bits[val] & lost:
+                        unsupported.append((var, val))
+        return unsupported
+
+    def str_revise(self):
+        return self.revise_scope()
+
+    def supports_given(self, var, val):
+        return self.line_sup_masks(var, val)
+
+    def line_refresh(self):
+        '''Internal routine. Recompute line_sup if any domain changed'''
+        if self.line_stamp == Variable.stamp:
+            return
+        self.line_sup = self.line_sup_masks()
+        self.line_stamp = Variable.stamp
+
+    def line_sup_masks(self, given=None, given_val=None):
+        '''Internal routine. Return, per scope position, the mask of the
+           values supported under the current domains, with the domain
+           of variable given (if not None) reduced to given_val'''
+        white, black = self.line_cells(given, given_val)
+        can_white, can_black = line_supports(self.clue, white, black)
+        return [(var.bits.get(0, 0) if can_white[p] else 0) |
+                (var.bits.get(1, 0) if can_black[p] else 0)
+                for p, var in zip(self.positions, self.scope)]
+
+    def line_cells(self, given=None, given_val=None):
+        '''Internal routine. Return white, black: for every cell of the
+           line whether it may be white, resp. black, under the current
+           domains, with the domain of variable given (if not None)
+           reduced to given_val'''
+        white = [val != 1 for val in self.known]
+        black = [val != 0 for val in self.known]
+        for p, var in zip(self.positions, self.scope):
+            if var is given:
+                white[p] = given_val == 0
+                black[p] = given_val == 1
+            else:
+                white[p] = var.in_cur_domain(0)
+                black[p] = var.in_cur_domain(1)
+        return white, black
+
+
+def mask_starts(block, mask):
+    '''Return the list of block starts whose bits are set in mask'''
+    lo = block.dom[0]
+    starts = []
+    while mask:
+        bit = mask & -mask
+        starts.append(lo + bit.bit_length() - 1)
+        mask ^= bit
+    return starts
+
+
+class BlockLineConstraint(Constraint):
+    '''One row or column of the block-start model
+       (nonogram_csp_model4): the scope is the block variables of the
+       clue followed by the cells of the line. A block variable's
+       domain is a range of consecutive start positions, so value s has
+       bit 1 << (s - dom[0]) and a set of starts is a bitmask.
+
+       The placements consistent with the current domains of both are
+       found by the dynamic program of line_block_supports, which
+       gives the supported values of every cell and the supported
+       starts of every block in O(span x blocks) time. The result, a
+       mask of supported values per scope position, is cached until
+       some domain changes, and so are the placement counts of
+       support_count, from the counting DP line_block_counts.'''
+
+    def __init__(self, name, blocks, cells, clue):
+        Constraint.__init__(self, name, list(blocks) + list(cells))
+        self.blocks = list(blocks)
+        self.cells = list(cells)
+        self.clue = list(clue)
+        self.index = dict((var, i) for i, var in enumerate(self.scope))
+        self.line_sup = None       #per scope position: mask of supported values
+        self.line_stamp = -1       #Variable.stamp line_sup was computed at
+        self.line_count = None     #per scope position: value --> placements giving it
+        self.count_stamp = -1      #Variable.stamp line_count was computed at
+
+    def add_satisfying_tuples(self, tuples):
+        print("Trying to add satisfying tuples to block constraint ", self)
+
+    def check(self, vals):
+        k = len(self.blocks)
+        line = vals[k:]
+        if get_line_clue(line) != self.clue:
+            return False
+        # the blocks must start where the runs of the line start
+        runs = [i for i in range(len(line)) if line[i] == 1 and (i == 0 or line[i-1] != 1)]
+        return runs == list(vals[:k])
+
+    def has_support(self, var, val):
+        self.line_refresh()
+        return self.line_sup[self.index[var]] & var.bits.get(val, 0) != 0
+
+    def supports_given(self, var, val):
+        return self.line_sup_masks(var, val)
+
+    def support_count(self, var, val):
+        '''The number of placements consistent with the current domains
+           that give var the value val: for a block, that start it at
+           val. The counts of every variable come from one run of
+           line_block_counts.'''
+        if self.count_stamp != Variable.stamp:
+            white, black, allowed = self.line_domains()
+            n_white, n_black, starts = line_block_counts(self.clue, white, black, allowed)
+            self.line_count = ([dict(enumerate(n)) for n in starts] +
+                               [{0: w, 1: b} for w, b in zip(n_white, n_black)])
+            self.count_stamp = Variable.stamp
+        return self.line_count[self.index[var]].get(val, 0)
+
+    def revise_scope(self):
+        '''Return the (var, val) pairs of the scope without support,
+           from one run of the line DP'''
+        self.line_refresh()
+        k = len(self.blocks)
+        unsupported = []
+        for i, (var, sup) in enumerate(zip(self.scope, self.line_sup)):
+            lost = var.cur_domain_mask() & ~sup
+            if not lost:
+                continue
+            if i < k:
+                unsupported.extend((var, s) for s in mask_starts(var, lost))
+            else:
+                for val in var.dom:
+                    if var.bits[val] & lost:
+                        unsupported.append((var, val))
+        return unsupported
+
+    def str_revise(self):
+        return self.revise_scope()
+
+    def line_refresh(self):
+        '''Internal routine. Recompute line_sup if any domain changed'''
+        if self.line_stamp == Variable.stamp:
+            return
+        self.line_sup = self.line_sup_masks()
+        self.line_stamp = Variable.stamp
+
+    def line_sup_masks(self, given=None, given_val=None):
+        '''Internal routine. Return, per scope position, the mask of the
+           values supported under the current domains, with the domain
+           of variable given (if not None) reduced to given_val'''
+        white, black, allowed = self.line_domains(given, given_val)
+        can_white, can_black, starts = line_block_supports(self.clue, white, black, allowed)
+        return ([sup >> block.dom[0] if block.dom else 0 for block, sup in zip(self.blocks, starts)] +
+                [(cell.bits.get(0, 0) if cw else 0) | (cell.bits.get(1, 0) if cb else 0)
+                 for cell, cw, cb in zip(self.cells, can_white, can_black)])
+
+    def line_domains(self, given=None, given_val=None):
+        '''Internal routine. Return the arguments white, black and
+           allowed of line_block_supports for the current domains, with
+           the domain of variable given (if not None) reduced to
+           given_val'''
+        white = [given_val == 0 if cell is given else cell.in_cur_domain(0) for cell in self.cells]
+        black = [given_val == 1 if cell is given else cell.in_cur_domain(1) for cell in self.cells]
+        allowed = [(1 << given_val if block is given else block.cur_domain_mask() << block.dom[0])
+                   if block.dom else 0 for block in self.blocks]
+        return white, black, allowed
+
+
+def line_supports(clue, white, black):
+    '''Given a clue (list of block lengths) and, for every cell of the
+       line, whether it may still be white and whether it may still be
+       black, return two lists telling for every cell whether it is
+       white, resp. black, in some placement of the clue consistent with
+       those possibilities. Both lists are all False if there is no such
+       placement. See line_block_supports.'''
+    can_white, can_black, starts = line_block_supports(clue, white, black)
+    return can_white, can_black
+
+
+def line_block_supports(clue, white, black, allowed=None):
+    '''line_supports, also restricting and reporting block starts:
+       allowed (if given) holds for every block the bitmask of the cells
+       it may start at (bit i for cell i). Returns can_white, can_black
+       and, for every block, the bitmask of the starts it has in some
+       consistent placement.
+
+       fwd[j][i] is True if the first i cells can hold exactly the first
+       j blocks, bwd[j][i] if the cells from i on can hold blocks j...
+       A block is always followed by a white separator cell unless it
+       ends the line.'''
+    n = len(white)
+    k = len(clue)
+
+    # no_black[i] = number of cells before i that cannot be black
+    no_black = [0] * (n + 1)
+    for i in range(n):
+        no_black[i+1] = no_black[i] + (0 if black[i] else 1)
+
+    def fits(s, j):
+        # block j can be placed at cells s..s+clue[j]-1 and is followed
+        # by the end of the line or a white cell
+        end = s + clue[j]
+        if end > n or no_black[end] != no_black[s]:
+            return False
+        if allowed is not None and not allowed[j] >> s & 1:
+            return False
+        return end == n or white[end]
+
+    def after(s, length):
+        # position following a block placed at s and its separator
+        return min(s + length + 1, n)
+
+    fwd = [[False] * (n + 1) for j in range(k + 1)]
+    fwd[0][0] = True
+    for i in range(n + 1):
+        for j in range(k + 1):
+            if not fwd[j][i]:
+                continue
+            if i < n and white[i]:
+                fwd[j][i+1] = True
+            if j < k and fits(i, j):
+                fwd[j+1][after(i, clue[j])] = True
+
+    bwd = [[False] * (n + 1) for j in range(k + 1)]
+    bwd[k][n] = True
+    for i in range(n - 1, -1, -1):
+        for j in range(k, -1, -1):
+            if white[i] and bwd[j][i+1]:
+                bwd[j][i] = True
+            elif j < k and fits(i, j) and bwd[j+1][after(i, clue[j])]:
+                bwd[j][i] = True
+
+    can_white = [False] * n
+    can_black = [False] * n
+    starts = [0] * k
+    if not bwd[0][0]:
+        return can_white, can_black, starts
+
+    cover = [0] * (n + 1)
+    for i in range(n):
+        for j in range(k + 1):
+            if not fwd[j][i]:
+                continue
+            if white[i] and bwd[j][i+1]:
+                can_white[i] = True
+            if j < k and fits(i, j) and bwd[j+1][after(i, clue[j])]:
+                end = i + clue[j]
+                starts[j] |= 1 << i
+                cover[i] += 1
+                cover[end] -= 1
+                if end < n:
+                    can_white[end] = True
+
+    covered = 0
+    for i in range(n):
+        covered += cover[i]
+        can_black[i] = covered > 0
+    return can_white, can_black, starts
+
+
+def line_block_counts(clue, white, black, allowed=None):
+    '''The counting version of line_block_supports, over the same
+       arguments: returns n_white, n_black and starts, where n_white[i]
+       (n_black[i]) is the number of placements of the clue consistent
+       with the possibilities that leave cell i white (colour it), and
+       starts[j][s] the number that start block j at cell s. Every
+       placement leaves each cell white or black, so n_white[i] +
+       n_black[i] is the total number of placements.
+
+       fwd[j][i] counts the ways the first i cells can hold exactly the
+       first j blocks, bwd[j][i] the ways the cells from i on can hold
+       blocks j..; a cell's counts are sums of their products, so one
+       forward and one backward pass count every cell.'''
+    n = len(white)
+    k = len(clue)
+
+    no_black = [0] * (n + 1)
+    for i in range(n):
+        no_black[i+1] = no_black[i] + (0 if black[i] else 1)
+
+    def fits(s, j):
+        end = s + clue[j]
+        if end > n or no_black[end] != no_black[s]:
+            return False
+        if allowed is not None and not allowed[j] >> s & 1:
+            return False
+        return end == n or white[end]
+
+    def after(s, length):
+        return min(s + length + 1, n)
+
+    fwd = [[0] * (n + 1) for j in range(k + 1)]
+    fwd[0][0] = 1
+    for i in range(n + 1):
+        for j in range(k + 1):
+            ways = fwd[j][i]
+            if not ways:
+                continue
+            if i < n and white[i]:
+                fwd[j][i+1] += ways
+            if j < k and fits(i, j):
+                fwd[j+1][after(i, clue[j])] += ways
+
+    bwd = [[0] * (n + 1) for j in range(k + 1)]
+    bwd[k][n] = 1
+    for i in range(n - 1, -1, -1):
+        for j in range(k, -1, -1):
+            ways = bwd[j][i+1] if white[i] else 0
+            if j < k and fits(i, j):
+                ways += bwd[j+1][after(i, clue[j])]
+            bwd[j][i] = ways
+
+    n_white = [0] * n
+    starts = [[0] * n for j in range(k)]
+    cover = [0] * (n + 1)
+    for i in range(n):
+        for j in range(k + 1):
+            ways = fwd[j][i]
+            if not ways:
+                continue
+            if white[i]:
+                n_white[i] += ways * bwd[j][i+1]
+            if j < k and fits(i, j):
+                placed = ways * bwd[j+1][after(i, clue[j])]
+                if not placed:
+                    continue
+                end = i + clue[j]
+                starts[j][i] += placed
+                cover[i] += placed
+                cover[end] -= placed
+                if end < n:
+                    n_white[end] += placed
+
+    n_black = [0] * n
+    covered = 0
+    for i in range(n):
+        covered += cover[i]
+        n_black[i] = covered
+    return n_white, n_black, starts
+
+
+def get_line_clue(vals):
+    '''Return the clue (list of block lengths, [] for an empty line)
+       described by a list of 0/1 cell values'''
+    clue = []
+    run = 0
+    for val in vals:
+        if val == 1:
+            run += 1
+        elif run:
+            clue.append(run)
+            run = 0
+    if run:
+        clue.append(run)
+    return clue
+
+
+def line_masks(span, clue):
+    '''Return, for every cell of a line of length span, the bitmask of
+       the placements of clue colouring it (placement k, in the order
+       line_tuples generates them, is bit k)'''
+    tuples = list(line_tuples(span, clue))
+    if not tuples:
+        return [0] * span
+    return [int(''.join(map(str, reversed(column))), 2) for column in zip(*tuples)]
+
+
+def line_known_counts(clue, known):
+    '''Return ways, where ways[j][i] is the number of placements of
+       blocks j.. of clue on the cells from i on of a line whose cells
+       have the values in known (0, 1 or None when undecided).
+       ways[0][0] is the number of placements of the whole line.'''
+    if list(clue) == [0]:
+        clue = []
+    n = len(known)
+    k = len(clue)
+
+    # white[i] = number of cells before i known to be white
+    white = [0] * (n + 1)
+    for i in range(n):
+        white[i+1] = white[i] + (1 if known[i] == 0 else 0)
+
+    ways = [[0] * (n + 1) for j in range(k + 1)]
+    ways[k][n] = 1
+    for i in range(n - 1, -1, -1):
+        ways[k][i] = ways[k][i+1] if known[i] != 1 else 0
+    for j in range(k - 1, -1, -1):
+        length = clue[j]
+        for i in range(n - 1, -1, -1):
+            count = ways[j][i+1] if known[i] != 1 else 0
+            end = i + length
+            if end <= n and white[end] == white[i]:
+                if end == n:
+                    count += ways[j+1][n]
+                elif known[end] != 1:
+                    count += ways[j+1][end+1]
+            ways[j][i] = count
+    return ways
+
+
+def line_tuples_known(clue, known):
+    '''Generate every placement of clue on a line whose cells have the
+       values in known (0, 1 or None when undecided), as tuples of 0/1
+       cell values. The counts of line_known_counts steer the search
+       away from dead ends, so the time is proportional to the size of
+       the output rather than to the number of unfiltered placements.'''
+    if list(clue) == [0]:
+        clue = []
+    n = len(known)
+    k = len(clue)
+    ways = line_known_counts(clue, known)
+    if not ways[0][0]:
         return
+    line = [0] * n
 
-    # Either pop a constraint, or assign a 0
-    # Assign 0
-    temp = list(current_tuple)
-    temp.append(0)
-    get_valid_nary_tuples(span-1, constraint, valid_tuples, temp)
-
-    # Pop constraint
-    if(len(constraint) != 0):
-        temp = list(current_tuple)
-        top_constraint = constraint.pop(0)
-        if (top_constraint > span):
-            # con't fit constraint
+    def place(j, i):
+        if j == k:
+            yield tuple(line)
             return
-        for i in range(top_constraint):
-            # "Color in" the specified number
-            temp.append(1)
-        span -= top_constraint
+        length = clue[j]
+        for s in range(i, n - length + 1):
+            end = s + length
+            after = min(end + 1, n)
+            if (all(known[c] != 0 for c in range(s, end)) and
+                    (end == n or known[end] != 1) and ways[j+1][after]):
+                line[s:end] = [1] * length
+                yield from place(j + 1, after)
+                line[s:end] = [0] * length
+            if known[s] == 1:
+                # the block cannot start past a black cell
+                break
+
+    yield from place(0, 0)
+
+
+def get_valid_nary_tuples(span, clue, valid_tuples):
+    '''Append every placement of clue on a line of length span to
+       valid_tuples (see line_tuples)'''
+    valid_tuples.extend(line_tuples(span, clue))
+
+
+def line_tuples(span, clue):
+    '''Generate, lazily, every placement of clue (a list of block
+       lengths, [0] or [] for an empty line) on a line of length span,
+       as tuples of 0/1 cell values.
+
+       With k blocks the line has slack = span - sum(clue) - (k-1) free
+       cells to share among the k+1 gaps. Choosing k "bars" among
+       slack+k slots (stars and bars) fixes the distribution: block j
+       starts at cut[j] + sum(clue[:j]). Each placement costs O(span),
+       so the total time is proportional to the size of the output.'''
+    if list(clue) == [0]:
+        clue = []
+    k = len(clue)
+    slack = span - sum(clue) - (k - 1)
+    if k == 0:
+        yield (0,) * span
+        return
+    if slack < 0:
+        return
 
-        if(span > 0):
-            # If there is space left, there must be a gap
-            temp.append(0)
-            span -= 1
+    offsets = [0] * k
+    for j in range(1, k):
+        offsets[j] = offsets[j-1] + clue[j-1]
+    blocks = [(1,) * length for length in clue]
+    for cut in itertools.combinations(range(slack + k), k):
+        line = [0] * span
+        for j in range(k):
+            start = cut[j] + offsets[j]
+            line[start:start + clue[j]] = blocks[j]
+        yield tuple(line)
 
-        get_valid_nary_tuples(span, constraint, valid_tuples, temp)
 ##############################
 
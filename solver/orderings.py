@@ -2,6 +2,7 @@
 #to be implemented.
 
 import random
+import heapq
 
 '''
 This file will contain different variable ordering heuristics to be used within
@@ -29,6 +30,118 @@ val_ordering == a function with the following template
 '''
 
 
+class VarIndex:
+    '''The unassigned variables of a CSP kept in a heap by a heuristic
+       key, so that a variable ordering can pick the variable with the
+       smallest key without looking at every variable.
+
+       key(var, index) is the key of an unassigned variable. Variables
+       tell the index when their domain size or assignment changes
+       (through their order_index attribute) and it pushes them again
+       with their new key, in O(log V). The entries a variable leaves
+       behind (its old keys, or every key once it is assigned) are
+       dropped lazily when they come to the top, and a heap is rebuilt
+       from the live keys once it holds more than twice as many
+       entries. Ties between equal keys go to the first variable of
+       the CSP.
+
+       If degrees is True the index also keeps, in degree, the dynamic
+       degree of every variable: its number of unassigned neighbours in
+       the constraint graph (see CSP.get_neighbours). It is counted
+       once and then updated as variables are assigned and unassigned,
+       and the neighbours of such a variable are pushed with their new
+       keys. Auxiliary variables (see CSP.add_var) are kept in a heap
+       of their own and only picked once every other variable is
+       assigned, as in CSP.get_all_unasgn_vars.
+
+       A variable reports to one index at a time. Building an index
+       takes its variables over from any other one, which then becomes
+       stale and is rebuilt the next time it is asked for (see
+       get_index).'''
+
+    def __init__(self, csp, name, key, degrees=False):
+        self.csp = csp
+        self.name = name
+        self.key = key
+        self.stale = False
+        self.keys = dict()       #variable --> its key, while in the index
+        self.heaps = {False: [], True: []}  #aux flag --> heap of (key, position, var)
+        self.position = var_positions(csp)
+        self.degree = None
+        if degrees:
+            self.degree = dict()
+            for var in csp.vars:
+                self.degree[var] = sum(1 for n in csp.get_neighbours(var) if not n.is_assigned())
+        for var in csp.vars:
+            if var.order_index is not None and var.order_index is not self:
+                var.order_index.stale = True
+            var.order_index = self
+            self.place(var)
+
+    def changed(self, var):
+        '''Push var with its current key (drop it if it is assigned),
+           and update the dynamic degrees if var was assigned or
+           unassigned'''
+        was_in = var in self.keys
+        self.place(var)
+        if self.degree is not None and was_in != (var in self.keys):
+            d = -1 if was_in else 1
+            for n in self.csp.get_neighbours(var):
+                if n in self.degree:
+                    self.degree[n] += d
+                    if n in self.keys:
+                        self.place(n)
+
+    def place(self, var):
+        '''Internal routine. Push var with its current key'''
+        old = self.keys.get(var)
+        new = None if var.is_assigned() else self.key(var, self)
+        if new == old:
+            return
+        if new is None:
+            del self.keys[var]
+            return
+        self.keys[var] = new
+        aux = var in self.csp.aux_vars
+        heap = self.heaps[aux]
+        heapq.heappush(heap, (new, self.position[var], var))
+        if len(heap) > 2 * len(self.keys) + 64:
+            heap[:] = [(k, self.position[v], v) for v, k in self.keys.items()
+                       if (v in self.csp.aux_vars) == aux]
+            heapq.heapify(heap)
+
+    def select(self):
+        '''Return the unassigned variable with the smallest key, the
+           first in the CSP on ties (None if every variable is
+           assigned)'''
+        keys = self.keys
+        for aux in (False, True):
+            heap = self.heaps[aux]
+            while heap:
+                key, position, var = heap[0]
+                if keys.get(var) == key:
+                    return var
+                heapq.heappop(heap)
+        return None
+
+
+def var_positions(csp):
+    '''Return dict var --> its position in csp.vars, the tie-break of
+       VarIndex'''
+    return dict((var, i) for i, var in enumerate(csp.vars))
+
+
+def get_index(csp, name, make_key, degrees=False):
+    '''Return the VarIndex of csp for the heuristic called name,
+       building it if csp has none (or one for another heuristic, or a
+       stale one) with the key function make_key(csp) returns'''
+    index = csp.order_index
+    if index is None or index.stale or index.name != name:
+        index = csp.order_index = VarIndex(csp, name, make_key(csp), degrees)
+    return index
+
+
+
 def ord_random(csp):
     '''
     ord_random(csp):
@@ -54,18 +167,20 @@ def ord_mrv(csp):
     according to the Minimum Remaining Values (MRV) heuristic as covered in lecture.  
     MRV returns the variable with the most constrained current domain 
     (i.e., the variable with the fewest legal values).
+
+    Ties are broken by the order of the variables in the CSP, which
+    for the nonogram models is row-major, so the search stays on the
+    line it is filling. The variables are kept in a VarIndex keyed by
+    domain size, which their prunings and assignments keep up to
+    date, so a pick does not look at every variable.
     '''
 #IMPLEMENT
-    all_unassigned_vars = csp.get_all_unasgn_vars()
-    min_domain_size = -1
+    return get_index(csp, 'mrv', mrv_key).select()
 
-    for var in all_unassigned_vars:
-        current_domain_size = var.cur_domain_size()
-        if (min_domain_size == -1 or current_domain_size < min_domain_size):
-            ret = var
-            min_domain_size = current_domain_size
 
-    return ret
+def mrv_key(csp):
+    '''Return the VarIndex key function of ord_mrv for csp'''
+    return lambda var, index: var.curdom_size
 
 def ord_dh(csp):
     '''
@@ -76,29 +191,20 @@ def ord_dh(csp):
     and there exists an edge from two variable nodes v1, v2 iff there exists
     at least one constraint that includes both v1 and v2,
     DH returns the variable whose node has highest degree.
+
+    The degree counts the unassigned neighbours only. The constraint
+    graph is the one the CSP builds as constraints are added (see
+    CSP.get_neighbours), and the degrees are kept by a VarIndex as
+    variables are assigned and unassigned, so a pick does not look at
+    every variable. Ties go to the first variable of the CSP.
     '''    
 #IMPLEMENT
-    all_unassigned_vars = csp.get_all_unasgn_vars()
-    connection_matrix = []
-    for i in range(0, len(all_unassigned_vars)):
-        connection_matrix.append([0] * len(all_unassigned_vars))
-    max_degree = -1
-
-    for constraint in csp.get_all_cons():
-        scope = constraint.get_scope()
-        for i, var1 in enumerate(all_unassigned_vars):
-            for j, var2 in enumerate(all_unassigned_vars):
-                if(i < j):
-                    in_scope = (var1 in scope) and (var2 in scope)
-                    if(in_scope):
-                        connection_matrix[i][j] = 1
-                        connection_matrix[j][i] = 1
-    degree_list = []
-    for i in range(0, len(all_unassigned_vars)):
-        degree_list.append(sum(connection_matrix[i]))
-    ret = all_unassigned_vars[degree_list.index(max(degree_list))]
-
-    return ret
+    return get_index(csp, 'dh', dh_key, degrees=True).select()
+
+
+def dh_key(csp):
+    '''Return the VarIndex key function of ord_dh'''
+    return lambda var, index: -index.degree[var]
 
 def val_lcv(csp,var):
     '''
@@ -111,64 +217,20 @@ def val_lcv(csp,var):
     to most constraining value in the $j-1$th index, if the variable has $j$ current domain values.) 
     The best value, according to LCV, is the one that rules out the fewest domain values in other 
     variables that share at least one constraint with var.
+
+    The values ruled out are counted by the constraints on var alone,
+    without assigning var (see Constraint.count_ruled_out): for table
+    constraints from the compact-table masks, a value of another
+    variable being ruled out if none of its live tuples gives var the
+    value. Ties keep the domain order.
     '''    
 #IMPLEMENT
-    value_constraint_pairs = []
-
-    # Count number of values in the domain of other variables unavailable before assignment
-    values_unavailable_before_assignment = 0
-    for constraint in csp.get_all_cons():
-        scope = constraint.get_scope()
-        if (var in scope):
-            for other_var in csp.get_all_unasgn_vars():
-                if(other_var in scope):
-                    if (other_var != var):
-                        for other_value in other_var.cur_domain():
-                            if (not constraint.has_support(other_var, other_value)):
-                                values_unavailable_before_assignment += 1
-
-    # Count the number of values unavailble after assignment of each 
-    for value in var.cur_domain():
-        # Assign Value
-        var.assign(value)
-
-        # Count number of values unavailable after assignment
-        values_unavailable_after_assignment = 0
-        for constraint in csp.get_all_cons():
-            scope = constraint.get_scope()
-            if (var in scope):
-                for other_var in csp.get_all_unasgn_vars():
-                    if(other_var in scope):
-                        for other_value in other_var.cur_domain():
-                            if (not constraint.has_support(other_var, other_value)):
-                                values_unavailable_after_assignment += 1
-
-        # Calculate the number of values eliminated when assigning this variable
-        values_eliminated = values_unavailable_after_assignment - values_unavailable_before_assignment
-        
-        # Unassign value
-        var.unassign()
-
-        # Add to list
-        if not value_constraint_pairs:
-            value_constraint_pairs.append((value, values_eliminated))
-        else:
-            # Find insertion point
-            assigned = False
-            for i in range(0, len(value_constraint_pairs)):
-                if (values_eliminated < value_constraint_pairs[i][1]):
-                    # Current value eliminates less values
-                    value_constraint_pairs.insert(i, (value, values_eliminated))
-                    assigned = True
-                    break
-            if (not assigned):
-                value_constraint_pairs.append((value, values_eliminated))
-
-    # Return list
-    ordered_list = []
-    for i in range(0, len(value_constraint_pairs)):
-        ordered_list.append(value_constraint_pairs[i][0])
-    return ordered_list
+    cons = csp.get_cons_with_var(var)
+    values = var.cur_domain()
+    values_eliminated = dict()
+    for value in values:
+        values_eliminated[value] = sum(c.count_ruled_out(var, value) for c in cons)
+    return sorted(values, key=lambda value: values_eliminated[value])
 
 def ord_custom(csp):
     '''
@@ -176,42 +238,176 @@ def ord_custom(csp):
     A var_ordering function that takes CSP object csp and returns Variable object var,
     according to a Heuristic of your design.  This can be a combination of the ordering heuristics 
     that you have defined above.
+
+    Picks the variable with the highest (DH) degree divided by its
+    (MRV) number of remaining values, from a VarIndex keeping both up
+    to date like ord_dh and ord_mrv do. Ties go to the first variable
+    of the CSP.
     '''    
 #IMPLEMENT
+    return get_index(csp, 'custom', custom_key, degrees=True).select()
 
-    # DH heuristic
-    # Re-implement instead of calling function to use connection_matrix
-    all_unassigned_vars = csp.get_all_unasgn_vars()
-    connection_matrix = []
-    for i in range(0, len(all_unassigned_vars)):
-        connection_matrix.append([0] * len(all_unassigned_vars))
-    max_degree = -1
-
-    for constraint in csp.get_all_cons():
-        scope = constraint.get_scope()
-        for i, var1 in enumerate(all_unassigned_vars):
-            for j, var2 in enumerate(all_unassigned_vars):
-                if(i < j):
-                    in_scope = (var1 in scope) and (var2 in scope)
-                    if(in_scope):
-                        connection_matrix[i][j] = 1
-                        connection_matrix[j][i] = 1
-    degree_list = []
-    for i in range(0, len(all_unassigned_vars)):
-        degree_list.append(sum(connection_matrix[i]))
-
-    # MRV heuristic
-    rv_list = []
-    for var in all_unassigned_vars:
-        current_domain_size = var.cur_domain_size()
-        rv_list.append(current_domain_size)
-
-    # Use a heuristic to choose "best" variable given degree and remaining values
-    # Divide dh by remaining values
-    heuristic_list = []
-    for i in range(0, len(all_unassigned_vars)):
-        heuristic_list.append(degree_list[i] / rv_list[i])
-    
-    ret = all_unassigned_vars[heuristic_list.index(max(heuristic_list))]
-    return ret
 
+def custom_key(csp):
+    '''Return the VarIndex key function of ord_custom'''
+    # Divide dh by remaining values (a wiped out domain is only seen
+    # until the propagator reports it)
+    return lambda var, index: -index.degree[var] / max(var.curdom_size, 1)
+
+
+def ord_maxsd(csp):
+    '''
+    ord_maxsd(csp):
+    A var_ordering function for the maximum solution density (maxSD)
+    heuristic. The solution density of a variable/value pair in a
+    constraint is the fraction of the constraint's tuples still valid
+    under the current domains that give the variable that value (for a
+    nonogram cell, the share of its line's remaining placements that
+    colour it, resp. leave it white). maxSD returns the variable of the
+    pair with the highest density in any constraint: the value most
+    likely to be right, to be tried first by val_maxsd.
+
+    The densities are kept by an SDIndex, which only recomputes those
+    of the constraints some of whose variables changed since the last
+    pick. Ties go to the first variable of the CSP, and auxiliary
+    variables are only picked once every other variable is assigned.
+    '''
+    index = csp.order_index
+    if index is None or index.stale or index.name != 'maxsd':
+        index = csp.order_index = SDIndex(csp)
+    return index.select()
+
+
+def val_maxsd(csp, var):
+    '''
+    val_maxsd(csp,var):
+    A val_ordering function returning var's current domain values
+    ordered by their highest solution density in the constraints on
+    var (see ord_maxsd), highest first. The densities are read from
+    the SDIndex of ord_maxsd if it is in use, and otherwise computed
+    for var alone.
+    '''
+    cons = csp.get_cons_with_var(var)
+    values = var.cur_domain()
+    index = csp.order_index
+    if isinstance(index, SDIndex) and not index.stale:
+        index.refresh()
+        sds = [index.sd[c] for c in cons]
+    else:
+        sds = []
+        for c in cons:
+            counts = [c.support_count(var, value) for value in values]
+            total = sum(counts)
+            sds.append(dict(((var, value), n / total if total else 0.0)
+                            for value, n in zip(values, counts)))
+    densities = dict()
+    for value in values:
+        densities[value] = max([sd.get((var, value), 0.0) for sd in sds] + [0.0])
+    return sorted(values, key=lambda value: -densities[value])
+
+
+class SDIndex(VarIndex):
+    '''VarIndex of ord_maxsd. It keeps the solution densities of every
+       constraint (see Constraint.solution_densities) and keys the
+       variables by their highest density. A change to a variable
+       marks the constraints on it dirty; before a pick only the dirty
+       constraints are recomputed, and only the variables of their
+       scopes are pushed with new keys.'''
+
+    def __init__(self, csp):
+        self.sd = dict((c, c.solution_densities()) for c in csp.get_all_cons())
+        self.dirty = set()
+        VarIndex.__init__(self, csp, 'maxsd', sd_key)
+
+    def changed(self, var):
+        self.dirty.update(self.csp.vars_to_cons[var])
+        self.place(var)
+
+    def refresh(self):
+        '''Recompute the densities of the dirty constraints and push
+           the variables of their scopes with their new keys'''
+        if not self.dirty:
+            return
+        touched = set()
+        for c in self.dirty:
+            self.sd[c] = c.solution_densities()
+            touched.update(c.scope)
+        self.dirty.clear()
+        for var in touched:
+            self.place(var)
+
+    def select(self):
+        self.refresh()
+        return VarIndex.select(self)
+
+
+def sd_key(var, index):
+    '''VarIndex key of ord_maxsd: the highest density of a pair of
+       var, negated'''
+    best = 0.0
+    for c in index.csp.vars_to_cons[var]:
+        sd = index.sd.get(c)
+        if sd:
+            for val in var.dom:
+                best = max(best, sd.get((var, val), 0.0))
+    return -best
+
+
+class WdegIndex(VarIndex):
+    '''VarIndex of ord_wdeg. It also keeps, for every constraint, the
+       number of unassigned variables of its scope, updated as
+       variables are assigned and unassigned, so that the weighted
+       degree of a variable can be summed over its own constraints.
+       When a constraint gets down to one unassigned variable, or back
+       up from it, that variable is pushed with its new key. Weight
+       changes reach the index through Constraint.record_wipeout.'''
+
+    def __init__(self, csp):
+        self.cons = dict((var, csp.get_cons_with_var(var)) for var in csp.vars)
+        self.n_unasgn = dict((c, c.get_n_unasgn()) for c in csp.get_all_cons())
+        VarIndex.__init__(self, csp, 'wdeg', wdeg_key)
+
+    def changed(self, var):
+        now_in = not var.is_assigned()
+        if now_in != (var in self.keys):
+            d = 1 if now_in else -1
+            for c in self.cons[var]:
+                self.n_unasgn[c] += d
+                if self.n_unasgn[c] == (2 if now_in else 1):
+                    # the other unassigned variable gained or lost c
+                    for other in c.scope:
+                        if other is not var and other in self.keys:
+                            self.place(other)
+        self.place(var)
+
+
+def wdeg_key(var, index):
+    '''VarIndex key of ord_wdeg: domain size over weighted degree'''
+    wdeg = 0
+    for c in index.cons[var]:
+        if index.n_unasgn[c] > 1:
+            wdeg += c.weight
+    if not wdeg:
+        return float('inf')
+    return var.curdom_size / wdeg
+
+
+def ord_wdeg(csp):
+    '''
+    ord_wdeg(csp):
+    A var_ordering function for the dom/wdeg heuristic. Every constraint
+    has a weight, bumped by the propagators each time the constraint
+    causes a failure (see Constraint.record_wipeout). The weighted
+    degree of a variable is the sum of the weights of its constraints
+    that are over at least one other unassigned variable, and dom/wdeg
+    returns the variable with the smallest current domain size divided
+    by its weighted degree: the search is drawn to the parts of the
+    problem where it has failed so far.
+
+    The variables are kept in a WdegIndex, so a pick does not look at
+    every variable.
+    '''
+    index = csp.order_index
+    if index is None or index.stale or index.name != 'wdeg':
+        index = csp.order_index = WdegIndex(csp)
+    return index.select()
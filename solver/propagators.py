@@ -6,10 +6,16 @@ propagator == a function with the following template
     propagator(csp, newly_instantiated_variable=None)
         ==> returns (True/False, [(Variable, Value), (Variable, Value) ...])
 
+When a propagator fails it reports the constraint that failed with
+Constraint.record_wipeout, for conflict-directed variable orderings.
+
 Consider implementing propagators for forward cehcking or GAC as a course project!        
 
 '''
 
+from collections import deque
+from cspbase import PropagationEngine
+
 def prop_BT(csp, newVar=None):
     '''Do plain backtracking propagation. That is, do no
     propagation at all. Just check fully instantiated constraints'''
@@ -23,13 +29,19 @@ def prop_BT(csp, newVar=None):
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                c.record_wipeout()
                 return False, []
     return True, []
 
 def prop_FC(csp, newVar=None):
+    '''Do forward checking. That is, prune the values of the last
+    unassigned variable of each constraint on newVar that have no
+    support. At the root (newVar is None) enforce GAC on every
+    constraint instead, see enforce_gac'''
+
     pruned_vals = []
     if not newVar:
-        return True, pruned_vals
+        return enforce_gac(csp, csp.get_all_cons())
     for c in csp.get_cons_with_var(newVar):
         if c.get_n_unasgn() == 1:
             unassigned_vars = c.get_unasgn_vars()
@@ -38,7 +50,11 @@ def prop_FC(csp, newVar=None):
             for val in unassigned_var.cur_domain():
                 has_support = c.has_support(unassigned_var, val)
                 if(not has_support):
+                    unassigned_var.prune_value(val)
                     pruned_vals.append((unassigned_var, val))
+            if unassigned_var.cur_domain_size() == 0:
+                c.record_wipeout()
+                return False, pruned_vals
 
         if c.get_n_unasgn() == 0:
             vals = []
@@ -46,37 +62,22 @@ def prop_FC(csp, newVar=None):
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
-                return False, []
+                c.record_wipeout()
+                return False, pruned_vals
     return True, pruned_vals
 
 def prop_GAC(csp, newVar=None):
-    '''Do plain backtracking propagation. That is, do no
-    propagation at all. Just check fully instantiated constraints'''
+    '''Do GAC propagation. Enforce GAC on the constraints of newVar
+    and on every constraint whose scope loses a value as a result.
+    At the root (newVar is None) GAC is enforced on every constraint,
+    which often fixes most of the cells before the first decision'''
 
-    pruned_vals = []
     if not newVar:
-        return True, pruned_vals
-
-    gac_que = []
-    for c in csp.get_cons_with_var(newVar):
-        gac_que.append(c)
+        return enforce_gac(csp, csp.get_all_cons())
 
-    # GAC enforce
-    while(len(gac_que) != 0):
-        c = gac_que.pop(0)
-        for v in c.get_scope():
-            for d in v.cur_domain():
-                has_support = c.has_support(v, d)
-                if(not has_support):
-                    v.prune_value(d)
-                    pruned_vals.append((v, d))
-
-                    if(len(v.cur_domain()) == 0):
-                        return False, pruned_vals
-                    else:
-                        for c_prime in csp.get_cons_with_var(v):
-                            if c_prime not in gac_que:
-                                gac_que.append(c_prime)
+    status, pruned_vals = enforce_gac(csp, csp.get_cons_with_var(newVar), newVar)
+    if not status:
+        return False, pruned_vals
 
     # Check each CSP is satisfied
     for c in csp.get_cons_with_var(newVar):
@@ -87,5 +88,107 @@ def prop_GAC(csp, newVar=None):
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                c.record_wipeout()
+                return False, pruned_vals
+    return True, pruned_vals
+
+def enforce_gac(csp, cons, changed_var=None):
+    '''Revise the constraints in cons, and those of every variable
+    that loses a value, until no unsupported value is left. Returns
+    (False, prunings) on a domain wipe out, (True, prunings) otherwise.
+
+    changed_var is the variable whose change (e.g. assignment) made
+    cons need revising. The constraints are queued on a
+    PropagationEngine, which the pruning events below feed. When only
+    one variable of a constraint changed it alone is not revised, as
+    the supports of its remaining values involve only the other,
+    unchanged, variables'''
+
+    engine = PropagationEngine(cons, changed_var)
+    outer = PropagationEngine.active
+    PropagationEngine.active = engine
+    try:
+        return gac_revise_all(engine)
+    finally:
+        PropagationEngine.active = outer
+
+def gac_revise_all(engine):
+    '''Internal routine of enforce_gac. Revise the constraints queued
+    on engine until it is empty'''
+
+    pruned_vals = []
+    while engine:
+        c, changed = engine.pop()
+        unsupported = c.revise_scope()
+        if unsupported is not None:
+            # The scope could be revised as a whole
+            if prune_all(unsupported, pruned_vals) is None:
+                c.record_wipeout()
                 return False, pruned_vals
+            continue
+
+        skip = None
+        if changed is not None and len(changed) == 1:
+            skip, = changed
+        for v in c.get_scope():
+            if v is skip:
+                continue
+            for d in v.cur_domain():
+                has_support = c.has_support(v, d)
+                if(not has_support):
+                    if v.is_assigned():
+                        # The assigned value has lost its support
+                        c.record_wipeout()
+                        return False, pruned_vals
+                    v.prune_value(d)
+                    pruned_vals.append((v, d))
+
+                    if(v.cur_domain_size() == 0):
+                        c.record_wipeout()
+                        return False, pruned_vals
+    return True, pruned_vals
+
+def prune_all(unsupported, pruned_vals):
+    '''Prune the (var, val) pairs in unsupported, each variable's values
+    at once (see Variable.prune_mask), and add them to pruned_vals.
+    Returns the variables pruned, or None on a domain wipe out (an
+    assigned value, or every value of a variable, unsupported)'''
+    lost = dict()
+    for v, d in unsupported:
+        lost[v] = lost.get(v, 0) | v.bits[d]
+    for v, mask in lost.items():
+        if v.is_assigned() or not v.cur_domain_mask() & ~mask:
+            return None
+    for v, mask in lost.items():
+        v.prune_mask(mask)
+    pruned_vals.extend(unsupported)
+    return list(lost)
+
+def prop_STR(csp, newVar=None):
+    '''Do GAC propagation with Simple Tabular Reduction (STR2). Each
+    constraint filters its table of live tuples once per revision and
+    reports every value of its scope left without support, instead of
+    asking has_support for each variable/value pair. Like prop_GAC it
+    revises every constraint at the root'''
+
+    pruned_vals = []
+    if not newVar:
+        str_que = deque(csp.get_all_cons())
+    else:
+        str_que = deque(csp.get_cons_with_var(newVar))
+    in_que = set(str_que)
+
+    while str_que:
+        c = str_que.popleft()
+        in_que.discard(c)
+        pruned_vars = prune_all(c.str_revise(), pruned_vals)
+        if pruned_vars is None:
+            # Domain wipe out
+            c.record_wipeout()
+            return False, pruned_vals
+        for v in pruned_vars:
+            for c_prime in csp.get_cons_with_var(v):
+                if c_prime is not c and c_prime not in in_que:
+                    str_que.append(c_prime)
+                    in_que.add(c_prime)
     return True, pruned_vals
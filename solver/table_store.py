@@ -0,0 +1,260 @@
+'''
+On-disk store of line tables, so that the placements of a clue are only
+enumerated once over many runs of the solver.
+
+Every (span, clue) table is kept in its own file of the store directory,
+in a compact binary format (integers are little-endian):
+
+    header    MAGIC, format version, span, number of blocks,
+              number of tuples, bytes per row, bytes per mask
+    clue      one uint32 per block
+    offsets   one uint64 per cell: file offset of the support mask of
+              that cell, i.e. the mask of the tuples colouring the cell
+    rows      the tuples, bit-packed: bit i of a row is cell i
+    masks     the support masks (bit k is tuple k), at the offsets above
+
+The files are memory-mapped when loaded (see MappedTable). The support
+masks are all the compact-table propagator needs, so a table constraint
+over a loaded table never lists its tuples; the rows are only decoded
+if some other code asks for them.
+
+Files are written to a temporary name and moved in place with
+os.replace, and are never modified once there, so any number of solver
+processes can read the store while others add to it. When the store
+grows over its size cap the least recently used files are removed;
+processes that have them mapped keep their mapping.
+'''
+
+import os
+import mmap
+import struct
+import tempfile
+import itertools
+from cspbase import TupleTable, np
+
+MAGIC = b'NGTB'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQII')
+
+#bits of each byte value, lowest bit first
+BYTE_BITS = [tuple((b >> j) & 1 for j in range(8)) for b in range(256)]
+
+
+class MappedTable(TupleTable):
+    '''A read-only TupleTable backed by a memory-mapped table file.
+
+       len(), arity, get_masks and contains are answered from the file
+       header and the support masks. tuples, sat_tuples and sup_tuples
+       are only built, by decoding the rows, on first access.'''
+
+    def __init__(self, path):
+        '''Map the table file at path. Raises OSError if it cannot be
+           read and ValueError if it is not a complete table file.'''
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError("truncated table file " + path)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, span, nblocks, ntuples, row_bytes, mask_bytes = \
+            HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            mm.close()
+            raise ValueError("not a table file " + path)
+        pos = HEADER.size
+        clue = list(struct.unpack_from('<{}I'.format(nblocks), mm, pos))
+        pos += 4 * nblocks
+        offsets = list(struct.unpack_from('<{}Q'.format(span), mm, pos))
+        pos += 8 * span
+        if (row_bytes != (span + 7) // 8 or mask_bytes != (ntuples + 7) // 8 or
+                size < pos + ntuples * row_bytes + span * mask_bytes or
+                any(off + mask_bytes > size for off in offsets)):
+            mm.close()
+            raise ValueError("corrupt table file " + path)
+
+        self.path = path
+        self.mm = mm
+        self.span = span
+        self.clue = clue
+        self.ntuples = ntuples
+        self.row_bytes = row_bytes
+        self.mask_bytes = mask_bytes
+        self.rows_offset = pos
+        self.offsets = offsets
+
+        self.arity = span if ntuples else None
+        self.matrix = None
+        self.masks = None
+        self.bit_rows = dict()
+        self.shared = True
+        self.decoded = None        #TupleTable of the decoded rows
+
+    def __len__(self):
+        return self.ntuples
+
+    @property
+    def tuples(self):
+        return self.get_decoded().tuples
+
+    @property
+    def sat_tuples(self):
+        return self.get_decoded().sat_tuples
+
+    @property
+    def sup_tuples(self):
+        return self.get_decoded().sup_tuples
+
+    def get_decoded(self):
+        '''Internal routine. Return the table's rows decoded into a
+           TupleTable, decoding them the first time.'''
+        if self.decoded is None:
+            self.decoded = TupleTable(self.iter_rows())
+        return self.decoded
+
+    def iter_rows(self):
+        '''Yield the tuples of the table, in file (i.e. bit) order'''
+        mm = self.mm
+        span = self.span
+        row_bytes = self.row_bytes
+        pos = self.rows_offset
+        for k in range(self.ntuples):
+            row = mm[pos:pos + row_bytes]
+            yield tuple(itertools.chain.from_iterable(BYTE_BITS[b] for b in row))[:span]
+            pos += row_bytes
+
+    def get_masks(self):
+        if self.masks is None:
+            full = (1 << self.ntuples) - 1
+            self.masks = []
+            for off in self.offsets:
+                black = int.from_bytes(self.mm[off:off + self.mask_bytes], 'little')
+                masks = dict()
+                if full & ~black:
+                    masks[0] = full & ~black
+                if black:
+                    masks[1] = black
+                self.masks.append(masks)
+        return self.masks
+
+    def contains(self, vals):
+        if len(vals) != self.span or not self.ntuples:
+            return False
+        masks = self.get_masks()
+        live = (1 << self.ntuples) - 1
+        for i, val in enumerate(vals):
+            live &= masks[i].get(val, 0)
+            if not live:
+                return False
+        return True
+
+    def copy(self):
+        return TupleTable(self.tuples)
+
+    def size_bytes(self):
+        #the masks count whether or not they are built yet, since the
+        #cache records the size when the table is added
+        nbytes = 2 * self.span * self.mask_bytes
+        if self.decoded is not None:
+            nbytes += self.decoded.size_bytes()
+        return nbytes
+
+
+class TableStore:
+    '''A directory of table files, keyed by (span, clue), holding at
+       most about max_bytes of them.'''
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.loads = 0
+        self.saves = 0
+        os.makedirs(path, exist_ok=True)
+
+    def file_name(self, span, clue):
+        return os.path.join(self.path, "{}_{}.tbl".format(
+            span, '-'.join(str(b) for b in clue) or 'empty'))
+
+    def load(self, span, clue):
+        '''Return the MappedTable stored for clue on a line of length
+           span, or None if there is none (or it is unreadable).'''
+        path = self.file_name(span, clue)
+        try:
+            table = MappedTable(path)
+        except (OSError, ValueError):
+            return None
+        if table.span != span or table.clue != list(clue):
+            return None
+        try:
+            #mark the file as recently used, for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        self.loads += 1
+        return table
+
+    def save(self, span, clue, table):
+        '''Store table, the placements of clue on a line of length span
+           (tuples of 0/1 values). Tables larger than the cap are not
+           stored.'''
+        ntuples = len(table)
+        row_bytes = (span + 7) // 8
+        mask_bytes = (ntuples + 7) // 8
+        masks_offset = HEADER.size + 4 * len(clue) + 8 * span + ntuples * row_bytes
+        if masks_offset + span * mask_bytes > self.max_bytes:
+            return
+
+        table_masks = table.get_masks() if ntuples else [dict() for i in range(span)]
+        header = HEADER.pack(MAGIC, VERSION, span, len(clue), ntuples, row_bytes, mask_bytes)
+        header += struct.pack('<{}I'.format(len(clue)), *clue)
+        header += struct.pack('<{}Q'.format(span),
+                              *[masks_offset + i * mask_bytes for i in range(span)])
+
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                if table.matrix is not None:
+                    #a MatrixTable: pack its rows without decoding them
+                    f.write(np.packbits(table.matrix, axis=1, bitorder='little').tobytes())
+                else:
+                    chunk = []
+                    for t in table.tuples:
+                        chunk.append(int(''.join(map(str, reversed(t))), 2).to_bytes(row_bytes, 'little'))
+                        if len(chunk) == 4096:
+                            f.write(b''.join(chunk))
+                            chunk = []
+                    f.write(b''.join(chunk))
+                for i in range(span):
+                    f.write(table_masks[i].get(1, 0).to_bytes(mask_bytes, 'little'))
+            os.replace(tmp, self.file_name(span, clue))
+        except OSError as e:
+            print("Could not store table for", span, clue, ":", e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.saves += 1
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used table files until the store is
+           back under max_bytes'''
+        files = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.tbl'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue          #removed by another process
+            files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
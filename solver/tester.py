@@ -7,6 +7,7 @@ import traceback
 import orderings
 import nonogram_csp
 import argparse
+from table_store import TableStore
 from problems import *
 
 NUM_TESTS = 42
@@ -18,6 +19,10 @@ PROPAGATOR = prop_GAC
 VARIABLE_ORDERING = orderings.ord_mrv
 VALUE_ORDERING = orderings.val_lcv
 
+#BT solver of each CSP solved so far. With --templates the puzzles of
+#one shape share a CSP, so its solver is reset and reused.
+SOLVERS = dict()
+
 def main():
     global NUM_TESTS
     global PROBLEM
@@ -65,7 +70,11 @@ def run_test(test_id):
     succ = False
     
     csp, var_array = MODEL(row, col)
-    solver = BT(csp)
+    solver = SOLVERS.get(csp)
+    if solver is None:
+        solver = BT(csp)
+        if nonogram_csp.USE_TEMPLATES:
+            SOLVERS[csp] = solver
     succ = solver.bt_search(PROPAGATOR, VARIABLE_ORDERING, VALUE_ORDERING)
 
     time_taken = (time.time() - start)
@@ -157,11 +166,21 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--problem', type=int, help='problem number to solve')
     parser.add_argument('--draw', dest='draw', action='store_true', help='draw solution')
-    parser.add_argument('--model', choices=['model1'], default='model1', help='select model (default: %(default)s)')
-    parser.add_argument('--propagator', choices=['bt', 'fc', 'gac'], default='gac', help='select propagator (default: %(default)s)')
-    parser.add_argument('--var_ordering', choices=['random', 'mrv', 'dh', 'custom'], default='mrv', help='select variable ordering heuristic (default: %(default)s)')
-    parser.add_argument('--val_ordering', choices=['arbitrary', 'lcv'], default='lcv', help='select value ordering heuristic (default: %(default)s)')
+    parser.add_argument('--model', choices=['model1', 'model2', 'model3', 'model4'], default='model1', help='select model (default: %(default)s)')
+    parser.add_argument('--propagator', choices=['bt', 'fc', 'gac', 'str'], default='gac', help='select propagator (default: %(default)s)')
+    parser.add_argument('--var_ordering', choices=['random', 'mrv', 'dh', 'custom', 'maxsd', 'wdeg'], default='mrv', help='select variable ordering heuristic (default: %(default)s)')
+    parser.add_argument('--val_ordering', choices=['arbitrary', 'lcv', 'maxsd'], default='lcv', help='select value ordering heuristic (default: %(default)s)')
+    parser.add_argument('--table_cache', metavar='DIR', help='keep the line tables of model1 in DIR across runs')
+    parser.add_argument('--table_cache_mb', type=int, default=1024, help='size cap of the table cache directory in MB (default: %(default)s)')
+    parser.add_argument('--tables', choices=['tuples', 'numpy'], default='tuples', help='representation of the model1 line tables (default: %(default)s)')
+    parser.add_argument('--table_budget_mb', type=int, default=64, help='largest table a model1 line may use before it gets a line constraint, in MB (default: %(default)s)')
+    parser.add_argument('--presolve', dest='presolve', action='store_true', help='decide what the clues alone force before building model1/model2')
+    parser.add_argument('--templates', dest='templates', action='store_true', help='build model1/model2 once per grid shape and rebind it to each puzzle')
+    parser.add_argument('--build_report', dest='build_report', action='store_true', help='print the tuple count of every line when building the model')
     parser.set_defaults(draw=False)
+    parser.set_defaults(build_report=False)
+    parser.set_defaults(presolve=False)
+    parser.set_defaults(templates=False)
 
     args = parser.parse_args()
 
@@ -170,9 +189,29 @@ def parse_args():
     
     DRAW = args.draw
 
+    if args.tables == 'numpy':
+        if np is None:
+            print("NumPy is not installed, using tuple tables")
+        else:
+            nonogram_csp.TABLE_CACHE.matrix = True
+
+    nonogram_csp.TABLE_BUDGET = args.table_budget_mb * 1024 * 1024
+    nonogram_csp.BUILD_REPORT = args.build_report
+    nonogram_csp.PRESOLVE = args.presolve
+    nonogram_csp.USE_TEMPLATES = args.templates
+
+    if args.table_cache is not None:
+        nonogram_csp.TABLE_CACHE.store = TableStore(args.table_cache, args.table_cache_mb * 1024 * 1024)
+
     model = args.model
     if(model == 'model1'):
         MODEL = nonogram_csp.nonogram_csp_model
+    elif(model == 'model2'):
+        MODEL = nonogram_csp.nonogram_csp_model2
+    elif(model == 'model3'):
+        MODEL = nonogram_csp.nonogram_csp_model3
+    elif(model == 'model4'):
+        MODEL = nonogram_csp.nonogram_csp_model4
 
     propagator = args.propagator
     if(propagator == 'bt'):
@@ -181,6 +220,8 @@ def parse_args():
         PROPAGATOR = prop_FC
     elif(propagator == 'gac'):
         PROPAGATOR = prop_GAC
+    elif(propagator == 'str'):
+        PROPAGATOR = prop_STR
 
     var_ordering = args.var_ordering
     if(var_ordering == 'random'):
@@ -191,12 +232,18 @@ def parse_args():
         VARIABLE_ORDERING = orderings.ord_dh
     elif(var_ordering == 'custom'):
         VARIABLE_ORDERING = orderings.ord_custom
+    elif(var_ordering == 'maxsd'):
+        VARIABLE_ORDERING = orderings.ord_maxsd
+    elif(var_ordering == 'wdeg'):
+        VARIABLE_ORDERING = orderings.ord_wdeg
 
     val_ordering = args.val_ordering
     if(val_ordering == 'arbitrary'):
         VALUE_ORDERING = orderings.val_arbitrary
     elif(val_ordering == 'lcv'):
         VALUE_ORDERING = orderings.val_lcv
+    elif(val_ordering == 'maxsd'):
+        VALUE_ORDERING = orderings.val_maxsd
 
     
         